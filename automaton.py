@@ -0,0 +1,73 @@
+class Automaton:
+    """
+    Aho-Corasick automaton over a set of patterns. Scanning a text finds
+    every occurrence of every pattern in a single pass over the text, no
+    matter how many patterns there are.
+    """
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for pattern in patterns:
+            self.insert(pattern)
+
+        self.link()
+
+
+    def insert(self, pattern):
+        """
+        Adds a pattern to the trie.
+        """
+        state = 0
+
+        for char in pattern:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+
+            state = self.goto[state][char]
+
+        if pattern and pattern not in self.output[state]:
+            self.output[state].append(pattern)
+
+
+    def link(self):
+        """
+        Sets the failure link of every state, breadth first, and adds the
+        output of each state's failure link onto its own.
+        """
+        queue = list(self.goto[0].values())
+
+        for state in queue:
+            for char, target in self.goto[state].items():
+                queue.append(target)
+
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+
+                self.fail[target] = self.goto[fail].get(char, 0)
+                self.output[target] = self.output[target] + self.output[self.fail[target]]
+
+
+    def scan(self, text):
+        """
+        Yields an (end, pattern) pair for each occurrence of a pattern in the
+        text, where end is the index of the last character of the occurrence.
+        """
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        state = 0
+
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+
+            state = goto[state].get(char, 0)
+
+            for pattern in output[state]:
+                yield i, pattern
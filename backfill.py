@@ -0,0 +1,158 @@
+import asyncio
+import json
+import os
+
+import discord
+
+from files import write_file
+
+
+class Checkpoints:
+    """
+    Progress of channel history backfills, kept in a JSON file so a backfill
+    that was interrupted resumes after the last message it wrote counts for.
+    Backfills are named by checkpoint_name, and each checkpoint holds the ID
+    of the last message counted ('after'), the ID of the message the
+    backfill stops at ('before') and whether it has finished ('done').
+
+    The file also keeps the ID of the message each user's word was added
+    in. Messages from then on were counted as they were sent, so a backfill
+    of the word stops there.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        self.since = {}
+
+        # Backfills in different servers can save at once, and every save
+        # writes through the same temporary file
+        self.lock = asyncio.Lock()
+
+
+    async def load(self):
+        """
+        Reads the checkpoints from their file, if there is one, without
+        blocking the event loop.
+        """
+        self.data, self.since = await asyncio.get_event_loop().run_in_executor(None, self.read)
+
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return {}, {}
+
+        with open(self.path) as reader:
+            data = json.load(reader)
+
+        # Checkpoints from before words were backfilled separately are left
+        # out, as they can't be resumed
+        return data.get('checkpoints', {}), data.get('since', {})
+
+
+    def get(self, name):
+        """
+        Returns the checkpoint of a backfill, or None if it has never run.
+        """
+        return self.data.get(name)
+
+
+    async def save(self, name, checkpoint):
+        """
+        Writes the checkpoint of a backfill. The file is replaced in one step
+        so an interrupted write never leaves it half written.
+        """
+        self.data[name] = dict(checkpoint)
+        await self.write()
+
+
+    def tracked_since(self, username, word):
+        """
+        Returns the ID of the message a user's word was added in, or None if
+        it was added before this was kept.
+        """
+        return self.since.get(username, {}).get(word)
+
+
+    async def track(self, username, word, message_id):
+        """
+        Keeps the ID of the message a user's word was added in.
+        """
+        self.since.setdefault(username, {})[word] = message_id
+        await self.write()
+
+
+    async def untrack(self, username, word=None):
+        """
+        Forgets when a user's word, or all of their words if no word is
+        given, was added.
+        """
+        if word is None:
+            removed = self.since.pop(username, None) is not None
+        else:
+            removed = self.since.get(username, {}).pop(word, None) is not None
+
+        if removed:
+            await self.write()
+
+
+    async def write(self):
+        async with self.lock:
+            data = json.dumps({'checkpoints': self.data, 'since': self.since})
+            await asyncio.get_event_loop().run_in_executor(None, write_file, self.path, data)
+
+
+def checkpoint_name(channel_id, username, words):
+    """
+    Returns the name of the checkpoint for backfilling a set of a user's
+    words in a channel. Each set of words has its own checkpoint, so words
+    added later can be backfilled without counting the others again.
+    """
+    return json.dumps([channel_id, username, sorted(set(words))])
+
+
+async def backfill(channel, checkpoints, name, before, count, flush, batch_size=500, pause=1.0,
+                   progress=None, progress_every=5000):
+    """
+    Streams a channel's history, oldest first, up to the message with ID
+    before, calling count(message) on each message. Progress is kept in the
+    checkpoint with the given name. Returns the number of messages read.
+
+    Counts are written by calling flush() every batch_size messages, and the
+    checkpoint is saved after each flush. Only one batch of messages is held
+    at a time, and the backfill sleeps for pause seconds between batches so
+    live messages are still handled promptly. progress(read) is awaited
+    every progress_every messages.
+    """
+    checkpoint = checkpoints.get(name) or {'after': None, 'before': before, 'done': False}
+
+    if checkpoint['done']:
+        return 0
+
+    after = discord.Object(checkpoint['after']) if checkpoint['after'] else None
+    history = channel.history(limit=None, after=after, before=discord.Object(checkpoint['before']),
+                              oldest_first=True)
+
+    read = 0
+    batch = 0
+
+    async for message in history:
+        count(message)
+        checkpoint['after'] = message.id
+        read += 1
+        batch += 1
+
+        if batch >= batch_size:
+            await flush()
+            await checkpoints.save(name, checkpoint)
+            batch = 0
+
+            await asyncio.sleep(pause)
+
+        if progress is not None and read % progress_every == 0:
+            await progress(read)
+
+    await flush()
+    checkpoint['done'] = True
+    await checkpoints.save(name, checkpoint)
+
+    return read
@@ -0,0 +1,61 @@
+"""
+Helpers shared by the benchmarks: random input, percentiles, and printing
+results against a saved baseline.
+"""
+import json
+import string
+
+
+def random_word(rng):
+    """
+    Returns a random lowercase word.
+    """
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 8)))
+
+
+def percentile(values, p):
+    """
+    Returns the pth percentile of a sorted list of values.
+    """
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def add_baseline_arguments(parser):
+    """
+    Adds the --save and --compare options to an argument parser.
+    """
+    parser.add_argument('--save', help='save the results as a baseline to this file')
+    parser.add_argument('--compare', help='compare the results against a saved baseline')
+
+
+def print_results(results, baseline=None):
+    """
+    Prints a flat dictionary of results, and how they changed from a baseline
+    if one is given.
+    """
+    width = max(len(key) for key in results)
+
+    for key, value in results.items():
+        line = '{0:>{1}}: {2:14.3f}'.format(key, width, value)
+
+        if baseline is not None and baseline.get(key):
+            line += '  ({0:+.1f}%)'.format((value - baseline[key]) / baseline[key] * 100)
+
+        print(line)
+
+
+def report(results, options):
+    """
+    Prints a flat dictionary of results, compared against the baseline in
+    options.compare if given, and saves them to options.save if given.
+    """
+    baseline = None
+    if options.compare:
+        with open(options.compare) as reader:
+            baseline = json.load(reader)
+
+    print_results(results, baseline)
+
+    if options.save:
+        with open(options.save, 'w') as writer:
+            json.dump(results, writer, indent=4)
@@ -0,0 +1,215 @@
+"""
+Replays synthetic messages through the bot's real on_message handler and
+reports throughput, latency and store calls per message. Latency is given
+both for on_message, which only queues the message, and from the message
+being queued until the bot has finished handling it.
+
+    python bench_messages.py
+    python bench_messages.py --words 200 --length 50 --save baseline.json
+    python bench_messages.py --words 200 --length 50 --compare baseline.json
+
+The bot runs against an in-memory store and fake authors and channels, so
+no Discord connection or database is needed.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+# Logs and history go to a scratch directory, not the bot's own files
+SCRATCH = tempfile.mkdtemp()
+
+os.environ['STORE'] = 'memory'
+os.environ['INCREMENT_LOG'] = os.path.join(SCRATCH, 'increments')
+os.environ['HISTORY_PATH'] = os.path.join(SCRATCH, 'history')
+os.environ['SPILL_PATH'] = os.path.join(SCRATCH, 'spill')
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import main
+
+from bench import add_baseline_arguments, percentile, random_word, report
+
+
+class FakeGuild:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeAuthor:
+    def __init__(self, id, name, discriminator):
+        self.id = id
+        self.name = name
+        self.discriminator = discriminator
+        self.mention = '<@{0}>'.format(self.id)
+
+
+    def __str__(self):
+        return self.name + '#' + self.discriminator
+
+
+class FakeChannel:
+    def __init__(self, guild):
+        self.id = 0
+        self.guild = guild
+        self.sent = 0
+
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+
+
+class FakeMessage:
+    def __init__(self, id, author, content, channel):
+        self.id = id
+        self.author = author
+        self.content = content
+        self.channel = channel
+        self.guild = channel.guild
+
+
+GUILD = FakeGuild(1)
+
+
+class CountingStore:
+    """
+    Wraps a store and counts every call made to it.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.calls = 0
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self.store, name)
+
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            self.calls += 1
+            return attribute(*args, **kwargs)
+
+        return call
+
+
+def elongate(rng, word):
+    """
+    Returns a spelling of a word with some of its letters repeated.
+    """
+    return ''.join(char * rng.randint(1, 4) for char in word)
+
+
+def make_corpus(options):
+    """
+    Returns the tracked users' words and a list of (author, content) messages
+    built from the given options.
+    """
+    rng = random.Random(options.seed)
+
+    authors = [FakeAuthor(i + 1, 'user{0}'.format(i), '{0:04d}'.format(i)) for i in range(options.users)]
+    tracked = authors[:max(1, int(len(authors) * options.tracked))]
+
+    users = {main.user_key(GUILD.id, author.id): {random_word(rng): 0 for _ in range(options.words)} for author in tracked}
+
+    messages = []
+    for _ in range(options.messages):
+        author = rng.choice(authors)
+        words = list(users.get(main.user_key(GUILD.id, author.id), {})) or [random_word(rng)]
+
+        tokens = []
+        for _ in range(options.length):
+            if rng.random() < options.hits:
+                word = rng.choice(words)
+                tokens.append(elongate(rng, word) if rng.random() < options.elongated else word)
+            else:
+                tokens.append(random_word(rng))
+
+        messages.append((author, ' '.join(tokens)))
+
+    return users, messages
+
+
+async def replay(options):
+    """
+    Replays a corpus through on_message and returns the results.
+    """
+    users, messages = make_corpus(options)
+
+    main.database = CountingStore(main.MemoryStore(users))
+    main.replies.window = 0
+    await main.load_words()
+
+    channel = FakeChannel(GUILD)
+    messages = [FakeMessage(i, author, content, channel) for i, (author, content) in enumerate(messages)]
+
+    main.database.calls = 0
+    latencies = []
+    queued = {}
+    handled = []
+
+    handle_message = main.handle_message
+
+    async def timed_handle_message(ctx):
+        await handle_message(ctx)
+        handled.append(time.perf_counter() - queued[ctx.id])
+
+    main.handle_message = timed_handle_message
+    main.ingest.start()
+
+    start = time.perf_counter()
+    for message in messages:
+        before = time.perf_counter()
+        queued[message.id] = before
+        await main.on_message(message)
+        latencies.append(time.perf_counter() - before)
+
+        # Let the ingest workers run between messages, as they would between
+        # gateway events
+        await asyncio.sleep(0)
+
+    await main.ingest.join()
+    elapsed = time.perf_counter() - start
+
+    await main.ingest.close()
+
+    await main.replies.flush()
+
+    main.handle_message = handle_message
+
+    latencies.sort()
+    handled.sort()
+
+    return {
+        'messages': len(messages),
+        'messages_per_second': len(messages) / elapsed,
+        'on_message_p50_ms': percentile(latencies, 50) * 1000,
+        'on_message_p99_ms': percentile(latencies, 99) * 1000,
+        'handled_p50_ms': percentile(handled, 50) * 1000 if handled else 0,
+        'handled_p99_ms': percentile(handled, 99) * 1000 if handled else 0,
+        'store_calls_per_message': main.database.calls / len(messages),
+        'replies_sent': channel.sent,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=10000, help='messages to replay')
+    parser.add_argument('--users', type=int, default=100, help='message authors')
+    parser.add_argument('--tracked', type=float, default=0.5, help='share of authors being tracked')
+    parser.add_argument('--words', type=int, default=20, help='tracked words per tracked user')
+    parser.add_argument('--length', type=int, default=12, help='words per message')
+    parser.add_argument('--hits', type=float, default=0.05, help='share of words that are tracked words')
+    parser.add_argument('--elongated', type=float, default=0.5, help='share of tracked words spelled elongated')
+    parser.add_argument('--seed', type=int, default=0)
+    add_baseline_arguments(parser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+
+    results = main.client.loop.run_until_complete(replay(options))
+
+    report(results, options)
@@ -0,0 +1,342 @@
+"""
+Drives the bot's storage operations against a local stand-in for the Replit
+database and reports requests, bytes and latency for each operation.
+
+    python bench_store.py
+    python bench_store.py --users 500 --words 50 --concurrency 16
+    python bench_store.py --strategy sharded --save baseline.json
+    python bench_store.py --strategy sharded --compare baseline.json
+
+The stand-in is the database proxy blueprint that ships with the replit
+package, served from a thread and backed by an in-memory dictionary. Two
+access strategies are compared:
+
+sharded  ReplitStore, with a key for each user. Only the keys are listed
+         on load, and each user is fetched and cached when first needed.
+blob     every user in one key, read and written whole by every operation,
+         as the bot did before users had their own keys.
+"""
+import argparse
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import replit
+import replit.database.server
+
+from flask import Flask, request
+from werkzeug.routing import PathConverter
+from werkzeug.serving import make_server
+
+from bench import add_baseline_arguments, percentile, random_word, report
+from store import MemoryStore, ReplitStore, Store
+
+DB_NAME = 'USERS'
+
+STRATEGIES = ('sharded', 'blob')
+
+
+class KeyValueStore(dict):
+    """
+    In-memory backing for the database proxy, which needs prefix() as well
+    as the dictionary methods.
+    """
+    def prefix(self, prefix):
+        return tuple(key for key in self if key.startswith(prefix))
+
+
+class Traffic:
+    """
+    Counts the requests served and the bytes sent and received. Requests are
+    served on their own threads, so the counts are kept under a lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+    def record(self, bytes_in, bytes_out):
+        with self.lock:
+            self.requests += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+
+    def snapshot(self):
+        with self.lock:
+            return self.requests, self.bytes_in, self.bytes_out
+
+
+class DatabaseServer:
+    """
+    The replit database proxy, served on a free local port from a thread.
+    """
+    def __init__(self):
+        self.data = KeyValueStore()
+        self.traffic = Traffic()
+
+        # The proxy reads its database from the module, which is None
+        # without a REPLIT_DB_URL
+        replit.database.server.db = self.data
+
+        app = Flask(__name__)
+
+        # Keys like USERS/1/2 contain slashes, which the hosted database
+        # accepts but the proxy's routes don't without a path converter
+        app.url_map.converters['default'] = PathConverter
+        app.register_blueprint(replit.database.server.make_database_proxy_blueprint(False))
+
+        @app.after_request
+        def count(response):
+            bytes_in = len(request.full_path) + (request.content_length or 0)
+            self.traffic.record(bytes_in, response.calculate_content_length() or 0)
+            return response
+
+        # Don't log every request
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+
+    def start(self):
+        self.thread.start()
+
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class BlobStore(Store):
+    """
+    Store that keeps every user in a single key of the Replit database and
+    reads it, and writes it back after a change, on every operation. The
+    old bot's database calls blocked, so operations run one at a time.
+    """
+    def __init__(self, db_url, key):
+        self.db = replit.AsyncDatabase(db_url)
+        self.key = key
+        self.lock = asyncio.Lock()
+
+
+    async def apply(self, operation, *args, write=False):
+        """
+        Runs a MemoryStore operation on the blob, and writes the blob back if
+        write is set.
+        """
+        async with self.lock:
+            try:
+                data = await self.db.get(self.key)
+            except KeyError:
+                data = {}
+
+            store = MemoryStore(data)
+            result = await getattr(store, operation)(*args)
+
+            if write:
+                await self.db.set(self.key, store.data)
+
+            return result
+
+
+    async def users(self, prefix=''):
+        return await self.apply('users', prefix)
+
+
+    async def has_user(self, username):
+        return await self.apply('has_user', username)
+
+
+    async def add_user(self, username):
+        await self.apply('add_user', username, write=True)
+
+
+    async def remove_user(self, username):
+        await self.apply('remove_user', username, write=True)
+
+
+    async def clear(self):
+        await self.apply('clear', write=True)
+
+
+    async def words(self, username):
+        return await self.apply('words', username)
+
+
+    async def add_word(self, username, word):
+        await self.apply('add_word', username, word, write=True)
+
+
+    async def remove_word(self, username, word):
+        await self.apply('remove_word', username, word, write=True)
+
+
+    async def clear_words(self, username):
+        await self.apply('clear_words', username, write=True)
+
+
+    async def increment(self, deltas):
+        await self.apply('increment', deltas, write=True)
+
+
+    async def to_dict(self):
+        return await self.apply('to_dict')
+
+
+    async def counts(self, username=None, prefix=''):
+        for row in [row async for row in MemoryStore(await self.to_dict()).counts(username, prefix)]:
+            yield row
+
+
+    async def close(self):
+        await self.db.sess.close()
+
+
+def make_store(strategy, db_url):
+    if strategy == 'sharded':
+        return ReplitStore(db_url, DB_NAME)
+    return BlobStore(db_url, DB_NAME)
+
+
+async def measure(server, calls, concurrency):
+    """
+    Runs a list of calls, each a function returning a coroutine, with at most
+    concurrency of them at once. Returns the requests, bytes and latency they
+    took.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run(call):
+        async with semaphore:
+            before = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - before)
+
+    requests, bytes_in, bytes_out = server.traffic.snapshot()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run(call) for call in calls])
+    elapsed = time.perf_counter() - start
+
+    after = server.traffic.snapshot()
+    latencies.sort()
+
+    return {
+        'calls': len(calls),
+        'requests_per_call': (after[0] - requests) / len(calls),
+        'bytes_sent_per_call': (after[1] - bytes_in) / len(calls),
+        'bytes_received_per_call': (after[2] - bytes_out) / len(calls),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'calls_per_second': len(calls) / elapsed,
+    }
+
+
+async def run_strategy(strategy, options):
+    """
+    Fills a fresh database through a store using the strategy, then measures
+    each operation the bot makes. Returns the results by operation.
+    """
+    rng = random.Random(options.seed)
+    server = DatabaseServer()
+    server.start()
+
+    usernames = ['{0}/{1}'.format(1, i + 1) for i in range(options.users)]
+    words = {username: [random_word(rng) for _ in range(options.words)] for username in usernames}
+
+    results = {}
+    store = make_store(strategy, server.url)
+
+    try:
+        results['add_user'] = await measure(server, [
+            lambda username=username: store.add_user(username) for username in usernames
+        ], options.concurrency)
+
+        results['add_word'] = await measure(server, [
+            lambda username=username, word=word: store.add_word(username, word)
+            for username in usernames for word in words[username]
+        ], options.concurrency)
+
+        # A fresh store, as the bot has when it starts
+        await store.close()
+        store = make_store(strategy, server.url)
+
+        results['load'] = await measure(server, [store.users], 1)
+
+        results['words'] = await measure(server, [
+            lambda username=username: store.words(username)
+            for username in rng.choices(usernames, k=options.reads)
+        ], options.concurrency)
+
+        def deltas():
+            batch = {}
+            for username in rng.choices(usernames, k=options.batch):
+                word = rng.choice(words[username])
+                batch.setdefault(username, {})[word] = batch.get(username, {}).get(word, 0) + 1
+            return batch
+
+        results['increment'] = await measure(server, [
+            lambda batch=deltas(): store.increment(batch) for _ in range(options.flushes)
+        ], options.concurrency)
+
+        async def count_all():
+            async for row in store.counts():
+                pass
+
+        results['counts'] = await measure(server, [count_all], 1)
+
+        results['remove_word'] = await measure(server, [
+            lambda username=username: store.remove_word(username, words[username][0])
+            for username in usernames[:options.removes]
+        ], options.concurrency)
+
+        results['database_bytes'] = {'total': sum(len(key) + len(value) for key, value in server.data.items())}
+    finally:
+        await store.close()
+        server.stop()
+
+    return results
+
+
+def flatten(results):
+    """
+    Returns nested results as a flat dictionary keyed like sharded.words.p50_ms.
+    """
+    return {'.'.join((strategy, operation, metric)): value
+            for strategy, operations in results.items()
+            for operation, metrics in operations.items()
+            for metric, value in metrics.items()}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--strategy', choices=STRATEGIES + ('all',), default='all')
+    parser.add_argument('--users', type=int, default=100, help='tracked users')
+    parser.add_argument('--words', type=int, default=20, help='tracked words per user')
+    parser.add_argument('--reads', type=int, default=1000, help='word lookups, as when a tracked word is said')
+    parser.add_argument('--flushes', type=int, default=50, help='bulk increments, as when counts are flushed')
+    parser.add_argument('--batch', type=int, default=100, help='increments in each flush')
+    parser.add_argument('--removes', type=int, default=50, help='words removed')
+    parser.add_argument('--concurrency', type=int, default=8, help='operations running at once')
+    parser.add_argument('--seed', type=int, default=0)
+    add_baseline_arguments(parser)
+    return parser.parse_args()
+
+
+async def run(options):
+    strategies = STRATEGIES if options.strategy == 'all' else (options.strategy,)
+    return {strategy: await run_strategy(strategy, options) for strategy in strategies}
+
+
+if __name__ == '__main__':
+    options = parse_args()
+
+    results = asyncio.run(run(options))
+
+    report(flatten(results), options)
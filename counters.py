@@ -0,0 +1,128 @@
+import asyncio
+
+
+class CounterBuffer:
+    """
+    Write-behind buffer for word counts. Increments are held in memory as
+    deltas and written to the store together in a single request, instead
+    of writing to the store on every tracked word.
+
+    If a log is given, every change is also appended to it so buffered
+    increments can be replayed after a restart.
+    """
+    def __init__(self, max_pending=100, log=None):
+        self.max_pending = max_pending
+        self.log = log
+        self.pending = {}
+        self.size = 0
+
+        # Flushes run one at a time, as each discards every segment rotated
+        # before it, including those of a flush still writing
+        self.lock = asyncio.Lock()
+
+
+    def increment(self, username, word, amount=1):
+        """
+        Buffers an increment for a user's word. Return True if the buffer has
+        reached its size threshold and should be flushed. Otherwise, return False.
+        """
+        if self.log is not None:
+            self.log.append(username, word, amount)
+
+        return self.merge(username, word, amount)
+
+
+    def merge(self, username, word, amount):
+        """
+        Buffers an increment without logging it.
+        """
+        words = self.pending.setdefault(username, {})
+        words[word] = words.get(word, 0) + amount
+        self.size += amount
+
+        return self.size >= self.max_pending
+
+
+    def count(self, username, word, stored):
+        """
+        Returns the count for a user's word, including any buffered increments
+        on top of the stored count.
+        """
+        return stored + self.pending.get(username, {}).get(word, 0)
+
+
+    def discard(self, username, word=None):
+        """
+        Drops buffered increments for a user's word, or for all of the user's
+        words if no word is given. Used when words or users are removed so a
+        later flush does not bring them back.
+        """
+        words = self.pending.get(username)
+
+        if words is None:
+            return
+
+        if self.log is not None:
+            self.log.append(username, word)
+
+        if word is None:
+            self.size -= sum(words.values())
+            del self.pending[username]
+        elif word in words:
+            self.size -= words.pop(word)
+
+
+    def clear(self):
+        """
+        Drops all buffered increments.
+        """
+        self.pending = {}
+        self.size = 0
+
+
+    def replay(self):
+        """
+        Buffers the increments in the log that were not written to the store
+        before the bot last stopped, and returns them.
+        """
+        if self.log is None:
+            return {}
+
+        deltas = self.log.replay()
+
+        for username, words in deltas.items():
+            for word, amount in words.items():
+                self.merge(username, word, amount)
+
+        return deltas
+
+
+    async def flush(self, store):
+        """
+        Writes all buffered increments to the store with a single bulk update
+        and returns them. If the write fails, the increments are kept to be
+        retried on the next flush. The log is compacted by dropping the
+        segments that were written. Flushes wait for each other.
+        """
+        async with self.lock:
+            if not self.pending:
+                return None
+
+            # Rotate first, so the increments are still buffered if it fails
+            segments = self.log.rotate() if self.log is not None else []
+
+            pending = self.pending
+            self.clear()
+
+            try:
+                await store.increment(pending)
+            except Exception:
+                for username, words in pending.items():
+                    for word, amount in words.items():
+                        self.merge(username, word, amount)
+                raise
+
+            if self.log is not None:
+                self.log.discard(segments)
+
+            return pending
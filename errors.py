@@ -1,12 +1,25 @@
+import asyncio
 import random
 
 class ErrorMessageGenerator:
     def __init__(self, file_name):
-        with open(file_name) as reader:
-            self.messages = reader.readlines()
+        self.file_name = file_name
+        self.messages = []
 
-        self.messages = [line.strip() for line in self.messages]
+
+    async def load(self):
+        """
+        Reads the messages from the file without blocking the event loop.
+        """
+        self.messages = await asyncio.get_event_loop().run_in_executor(None, self.read)
+
+
+    def read(self):
+        with open(self.file_name) as reader:
+            return [line.strip() for line in reader.readlines()]
 
 
     def get_random_message(self):
-        return self.messages[random.randrange(len(self.messages))]
\ No newline at end of file
+        if not self.messages:
+            return 'An error occured whilst trying to run your command.'
+        return self.messages[random.randrange(len(self.messages))]
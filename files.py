@@ -0,0 +1,17 @@
+import os
+
+
+def write_file(path, data):
+    """
+    Replaces a file with the given text. The text is written to a temporary
+    file and synced to disk first, then moved over the file in one step, so
+    an interrupted write never leaves it half written.
+    """
+    temp_path = path + '.tmp'
+
+    with open(temp_path, 'w') as writer:
+        writer.write(data)
+        writer.flush()
+        os.fsync(writer.fileno())
+
+    os.replace(temp_path, path)
@@ -0,0 +1,39 @@
+from leaderboard import Leaderboard
+
+
+def user_key(guild_id, user_id):
+    """
+    Returns the key a user's words are kept under in a server. Users are keyed
+    by their ID, which stays the same when they change their username.
+    """
+    return '{0}/{1}'.format(guild_id, user_id)
+
+
+def parse_user_key(key):
+    """
+    Returns the (guild_id, user_id) a user key was made from.
+    """
+    guild_id, user_id = key.split('/')
+    return int(guild_id), int(user_id)
+
+
+def is_legacy_key(key):
+    """
+    Return True if the key is a name#discriminator username from before users
+    were kept per server. Otherwise, return False.
+    """
+    return '#' in key
+
+
+class GuildState:
+    """
+    Settings, pending confirmations and the leaderboard of a single server,
+    so servers never share or contend over state.
+    """
+    def __init__(self):
+        self.channel = None
+        self.enabled = True
+        self.try_purge_words = False
+        self.try_purge_users = False
+        self.backfilling = False
+        self.leaderboard = Leaderboard()
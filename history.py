@@ -0,0 +1,249 @@
+import asyncio
+import base64
+import json
+import os
+import time
+
+from array import array
+from datetime import datetime, timezone
+
+from files import write_file
+
+HOURS = 168
+DAYS = 62
+MONTHS = 24
+
+HOUR = 3600
+DAY = 86400
+
+
+def month_of(timestamp):
+    """
+    Returns the number of the calendar month a timestamp is in, counted from
+    year 0, in UTC.
+    """
+    date = datetime.fromtimestamp(timestamp, timezone.utc)
+    return date.year * 12 + date.month - 1
+
+
+class Buckets:
+    """
+    Ring buffer of counts for the last size periods, kept in an array of
+    unsigned ints. Slots are reused as time moves on, so the memory used
+    never grows.
+    """
+    def __init__(self, size, latest=0, counts=None):
+        self.size = size
+        self.latest = latest
+        self.counts = counts if counts is not None else array('I', bytes(4 * size))
+
+
+    def advance(self, period):
+        """
+        Moves the newest slot on to a period, emptying the slots of the
+        periods that were skipped.
+        """
+        if period <= self.latest:
+            return
+
+        for skipped in range(max(self.latest + 1, period - self.size + 1), period + 1):
+            self.counts[skipped % self.size] = 0
+
+        self.latest = period
+
+
+    def add(self, period, amount):
+        """
+        Adds an amount to a period's slot, which can be negative but never
+        takes the slot below zero. Periods too old to have a slot are ignored.
+        """
+        self.advance(period)
+
+        if period > self.latest - self.size:
+            slot = period % self.size
+            self.counts[slot] = max(0, self.counts[slot] + amount)
+
+
+    def total(self, since, now):
+        """
+        Returns the sum of the slots from period since up to period now.
+        """
+        self.advance(now)
+        return sum(self.counts[period % self.size] for period in range(max(since, now - self.size + 1), now + 1))
+
+
+    def covers(self, since, now):
+        """
+        Return True if period since still has a slot. Otherwise, return False.
+        """
+        return since > now - self.size
+
+
+    def to_dict(self):
+        return {'latest': self.latest, 'counts': base64.b64encode(self.counts.tobytes()).decode('ascii')}
+
+
+    @classmethod
+    def from_dict(cls, size, data):
+        counts = array('I')
+        counts.frombytes(base64.b64decode(data['counts']))
+
+        return cls(size, data['latest'], counts)
+
+
+class WordHistory:
+    """
+    Counts of when each user's words were said, in hourly buckets for the
+    last week, daily buckets for the last two months and monthly buckets for
+    the last two years. Every count goes into all three, so a window is
+    answered from the finest buckets that reach back far enough, to the
+    resolution of those buckets. Each user's word takes the same fixed space
+    however long the bot runs.
+
+    The history is kept in a JSON file, with each array stored as base64.
+    The encoded form of every user's word is kept too, so a save only
+    encodes the words that changed and the file is written off the event
+    loop.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.series = {}
+        self.encoded = {}
+        self.lock = asyncio.Lock()
+
+        # The (username, word) pairs changed since the last save, where word
+        # is None when all of a user's words were removed
+        self.changed = set()
+
+        # The month of the last hour counted, as working it out is slow
+        self.hour = None
+        self.month = None
+
+
+    async def load(self):
+        """
+        Reads the history from its file, if there is one, without blocking
+        the event loop.
+        """
+        self.encoded, self.series = await asyncio.get_event_loop().run_in_executor(None, self.read)
+
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return {}, {}
+
+        with open(self.path) as reader:
+            encoded = json.load(reader)
+
+        series = {}
+        for username, words in encoded.items():
+            series[username] = {
+                word: (Buckets.from_dict(HOURS, buckets[0]),
+                       Buckets.from_dict(DAYS, buckets[1]),
+                       Buckets.from_dict(MONTHS, buckets[2]))
+                for word, buckets in words.items()
+            }
+
+        return encoded, series
+
+
+    def increment(self, username, word, amount=1, timestamp=None):
+        """
+        Adds an amount to a user's word at a time, or now if no time is given.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        words = self.series.setdefault(username, {})
+
+        if word not in words:
+            words[word] = (Buckets(HOURS), Buckets(DAYS), Buckets(MONTHS))
+
+        hour = int(timestamp // HOUR)
+
+        if hour != self.hour:
+            self.hour = hour
+            self.month = month_of(timestamp)
+
+        hours, days, months = words[word]
+        hours.add(hour, amount)
+        days.add(int(timestamp // DAY), amount)
+        months.add(self.month, amount)
+
+        self.changed.add((username, word))
+
+
+    def count(self, username, word, seconds, now=None):
+        """
+        Returns how many times a user said a word in the last number of
+        seconds.
+        """
+        buckets = self.series.get(username, {}).get(word)
+
+        if buckets is None:
+            return 0
+
+        if now is None:
+            now = time.time()
+
+        since = now - seconds
+        hours, days, months = buckets
+
+        if hours.covers(int(since // HOUR), int(now // HOUR)):
+            return hours.total(int(since // HOUR), int(now // HOUR))
+        if days.covers(int(since // DAY), int(now // DAY)):
+            return days.total(int(since // DAY), int(now // DAY))
+        return months.total(month_of(max(since, 0)), month_of(now))
+
+
+    def remove_word(self, username, word):
+        """
+        Removes the history of a user's word.
+        """
+        if self.series.get(username, {}).pop(word, None) is not None:
+            self.changed.add((username, word))
+
+
+    def remove_user(self, username):
+        """
+        Removes the history of all of a user's words.
+        """
+        if self.series.pop(username, None) is not None:
+            self.changed.add((username, None))
+
+
+    async def save(self):
+        """
+        Writes the history to its file if it has changed. The file is replaced
+        in one step so an interrupted write never leaves it half written.
+        """
+        async with self.lock:
+            if not self.changed:
+                return
+
+            changed = self.changed
+            self.changed = set()
+
+            # Removed users first, so words added back since are kept
+            for username, word in changed:
+                if word is None:
+                    self.encoded.pop(username, None)
+
+            for username, word in changed:
+                if word is None:
+                    continue
+
+                series = self.series.get(username, {}).get(word)
+
+                if series is not None:
+                    self.encoded.setdefault(username, {})[word] = [buckets.to_dict() for buckets in series]
+                elif username in self.encoded:
+                    self.encoded[username].pop(word, None)
+
+            # Only save changes the encoded history, so it can be serialized
+            # on another thread while the lock is held
+            await asyncio.get_event_loop().run_in_executor(None, self.write)
+
+
+    def write(self):
+        write_file(self.path, json.dumps(self.encoded))
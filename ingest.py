@@ -0,0 +1,188 @@
+import asyncio
+import json
+import os
+import traceback
+
+import metrics
+
+POLICIES = ('drop', 'spill', 'degrade')
+
+
+class MessageQueue:
+    """
+    Bounded queue of messages waiting to be checked, handled by a pool of
+    worker tasks so slow matching or store calls never hold up the gateway
+    or commands.
+
+    Each message is put on the queue along with a record, a list of plain
+    values that is enough to count its words without replying. When the
+    queue is full the policy decides what happens:
+
+    drop     the message is not counted.
+    spill    the record is appended to a file, which is counted once the
+             queue has emptied.
+    degrade  the record is counted straight away, but there is no reply.
+    """
+    def __init__(self, handle, count, size=1000, workers=4, policy='drop', spill_path=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown queue policy {0}.'.format(policy))
+
+        self.handle = handle
+        self.count = count
+        self.queue = asyncio.Queue(size)
+        self.workers = workers
+        self.policy = policy
+        self.spill_path = spill_path
+        self.spill = None
+        self.spilled = 0
+        self.draining = False
+        self.ready = None
+        self.tasks = []
+
+        # Records spilled before the bot last stopped are counted on start
+        if spill_path is not None and (os.path.exists(spill_path) or os.path.exists(spill_path + '.draining')):
+            self.spilled = 1
+
+
+    def running(self):
+        return len(self.tasks) > 0
+
+
+    def start(self, ready=None):
+        """
+        Starts the worker tasks on the running event loop. If an event is
+        given, spilled records are only counted once it is set, as counting
+        them needs the bot's data to be loaded.
+        """
+        self.ready = ready
+        self.tasks = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+
+        if self.spilled:
+            self.tasks.append(asyncio.ensure_future(self.drain_when_ready()))
+
+
+    def is_ready(self):
+        return self.ready is None or self.ready.is_set()
+
+
+    async def put(self, message, record):
+        """
+        Queues a message to be handled, applying the policy if the queue is
+        full.
+        """
+        try:
+            self.queue.put_nowait(message)
+            return
+        except asyncio.QueueFull:
+            metrics.INGEST_OVERFLOW.inc(1, self.policy)
+
+        if self.policy == 'degrade':
+            await self.count(*record)
+        elif self.policy == 'spill':
+            if self.spill is None:
+                self.spill = open(self.spill_path, 'a', encoding='utf-8')
+
+            self.spill.write(json.dumps(record) + '\n')
+            self.spilled += 1
+
+
+    async def work(self):
+        while True:
+            message = await self.queue.get()
+
+            try:
+                await self.handle(message)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+            if self.spilled and self.queue.empty() and self.is_ready():
+                await self.drain()
+
+
+    async def drain_when_ready(self):
+        """
+        Counts the records spilled before the bot last stopped, once it is
+        ready to.
+        """
+        if self.ready is not None:
+            await self.ready.wait()
+
+        await self.drain()
+
+
+    async def drain(self):
+        """
+        Counts the spilled records. Records spilled while draining are left
+        for the next drain.
+        """
+        if self.draining:
+            return
+
+        self.draining = True
+
+        try:
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+
+            draining_path = self.spill_path + '.draining'
+
+            # A drain cut short last time is finished first
+            if not os.path.exists(draining_path):
+                if not os.path.exists(self.spill_path):
+                    self.spilled = 0
+                    return
+
+                os.replace(self.spill_path, draining_path)
+                self.spilled = 0
+
+            with open(draining_path, encoding='utf-8') as reader:
+                for line in reader:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    try:
+                        await self.count(*record)
+                    except Exception:
+                        traceback.print_exc()
+
+            os.remove(draining_path)
+        finally:
+            self.draining = False
+
+
+    def depth(self):
+        """
+        Returns the number of messages waiting, including spilled records.
+        """
+        return self.queue.qsize() + self.spilled
+
+
+    async def join(self):
+        """
+        Waits until every queued message and spilled record has been handled.
+        """
+        await self.queue.join()
+
+        if self.spilled:
+            await self.drain()
+
+
+    async def close(self):
+        """
+        Handles the messages left on the queue and stops the worker tasks.
+        """
+        if self.running():
+            await self.join()
+
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
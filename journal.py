@@ -0,0 +1,124 @@
+import asyncio
+import glob
+import json
+import os
+
+
+class IncrementLog:
+    """
+    Append-only log of buffered word count changes, so increments that have
+    not been written to the store yet survive a restart. Each change is one
+    JSON line: [username, word, amount] for an increment, or [username, word]
+    for dropped increments, where word is null for all of a user's words.
+
+    Appending only writes to the file's buffer. sync() pushes buffered lines
+    to disk with one fsync, so many increments share each fsync. When counts
+    are written to the store the log is rotated into a numbered segment,
+    which is deleted once the write has succeeded.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.segment = self.last_segment()
+        self.file = open(path, 'a', encoding='utf-8')
+        self.dirty = False
+
+
+    def segments(self):
+        """
+        Returns the paths of the rotated segments, oldest first.
+        """
+        paths = glob.glob(glob.escape(self.path) + '.*')
+        paths = [path for path in paths if path.rsplit('.', 1)[1].isdigit()]
+
+        return sorted(paths, key=lambda path: int(path.rsplit('.', 1)[1]))
+
+
+    def last_segment(self):
+        segments = self.segments()
+        return int(segments[-1].rsplit('.', 1)[1]) if segments else 0
+
+
+    def append(self, *record):
+        """
+        Adds a change to the log.
+        """
+        self.file.write(json.dumps(record) + '\n')
+        self.dirty = True
+
+
+    async def sync(self):
+        """
+        Writes appended changes to disk, if there are any.
+        """
+        if not self.dirty:
+            return
+
+        self.dirty = False
+        self.file.flush()
+
+        # rotate() can close the file while the fsync runs, so sync a
+        # descriptor of our own, which still refers to the rotated segment
+        descriptor = os.dup(self.file.fileno())
+
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, os.fsync, descriptor)
+        finally:
+            os.close(descriptor)
+
+
+    def rotate(self):
+        """
+        Moves the changes logged so far into a new segment and starts an empty
+        log. Returns the paths of every segment, which can be deleted once the
+        changes in them have been written to the store.
+        """
+        self.file.close()
+
+        self.segment += 1
+        os.replace(self.path, '{0}.{1}'.format(self.path, self.segment))
+
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.dirty = False
+
+        return self.segments()
+
+
+    def discard(self, segments):
+        """
+        Deletes segments whose changes have been written to the store.
+        """
+        for path in segments:
+            os.remove(path)
+
+
+    def replay(self):
+        """
+        Returns the changes in every segment and the current log as a
+        dictionary of users to words to amounts. A line cut short by a crash
+        is skipped.
+        """
+        self.file.flush()
+        deltas = {}
+
+        for path in self.segments() + [self.path]:
+            with open(path, encoding='utf-8') as reader:
+                for line in reader:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    if len(record) == 3:
+                        username, word, amount = record
+                        words = deltas.setdefault(username, {})
+                        words[word] = words.get(word, 0) + amount
+                    elif record[1] is None:
+                        deltas.pop(record[0], None)
+                    else:
+                        deltas.get(record[0], {}).pop(record[1], None)
+
+        return deltas
+
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,168 @@
+import bisect
+
+from words import collapse
+
+
+class Ranking:
+    """
+    Scores kept in descending order as they change, so the top entries can be
+    read straight off the front instead of sorting every score.
+    """
+    def __init__(self):
+        self.scores = {}
+        self.order = []
+
+
+    def add(self, key, amount):
+        """
+        Adds an amount onto a key's score.
+        """
+        score = self.scores.get(key, 0)
+
+        if key in self.scores:
+            self.discard(key, score)
+
+        self.scores[key] = score + amount
+        bisect.insort(self.order, (-(score + amount), key))
+
+
+    def remove(self, key):
+        """
+        Removes a key from the ranking.
+        """
+        if key in self.scores:
+            self.discard(key, self.scores.pop(key))
+
+
+    def discard(self, key, score):
+        """
+        Removes a key's entry from the ordered scores.
+        """
+        i = bisect.bisect_left(self.order, (-score, key))
+        del self.order[i]
+
+
+    def top(self, n):
+        """
+        Returns a list of the n highest (key, score) pairs.
+        """
+        return [(key, -score) for score, key in self.order[:n]]
+
+
+    def __len__(self):
+        return len(self.scores)
+
+
+class Leaderboard:
+    """
+    Rankings of users by their total count, of users by their count of each
+    word, and of each user's words by count. Updated on every increment so the
+    top users or words are available without scanning the database. Words
+    are ranked by their canonical form, so different spellings of the same
+    word tracked for different users are ranked together.
+    """
+    def __init__(self):
+        self.totals = Ranking()
+        self.words = {}
+        self.user_words = {}
+
+
+    def build(self, users):
+        """
+        Rebuilds the leaderboard from a dictionary of users to word counts.
+        """
+        self.clear()
+
+        for username, words in users.items():
+            for word, count in words.items():
+                if count > 0:
+                    self.increment(username, word, count)
+
+
+    def increment(self, username, word, amount=1):
+        """
+        Adds onto a user's count of a word.
+        """
+        self.totals.add(username, amount)
+        self.words.setdefault(collapse(word), Ranking()).add(username, amount)
+        self.user_words.setdefault(username, Ranking()).add(word, amount)
+
+
+    def remove_word(self, username, word):
+        """
+        Removes a user's word from the leaderboard.
+        """
+        words = self.user_words.get(username)
+
+        if words is None or word not in words.scores:
+            return
+
+        count = words.scores[word]
+        words.remove(word)
+        self.totals.add(username, -count)
+
+        canonical = collapse(word)
+        self.words[canonical].remove(username)
+
+        if len(self.words[canonical]) == 0:
+            del self.words[canonical]
+
+        if len(words) == 0:
+            self.remove_user(username)
+
+
+    def remove_user(self, username):
+        """
+        Removes a user and all of their words from the leaderboard.
+        """
+        words = self.user_words.pop(username, None)
+
+        if words is None:
+            return
+
+        for word in words.scores:
+            canonical = collapse(word)
+            self.words[canonical].remove(username)
+
+            if len(self.words[canonical]) == 0:
+                del self.words[canonical]
+
+        self.totals.remove(username)
+
+
+    def clear(self):
+        """
+        Removes everyone from the leaderboard.
+        """
+        self.totals = Ranking()
+        self.words = {}
+        self.user_words = {}
+
+
+    def top_users(self, n):
+        """
+        Returns the n users with the highest total counts.
+        """
+        return self.totals.top(n)
+
+
+    def top_users_for_word(self, word, n):
+        """
+        Returns the n users who have said a word the most.
+        """
+        ranking = self.words.get(collapse(word))
+
+        if ranking is None:
+            return []
+        return ranking.top(n)
+
+
+    def top_words(self, username, n):
+        """
+        Returns a user's n most said words.
+        """
+        ranking = self.user_words.get(username)
+
+        if ranking is None:
+            return []
+        return ranking.top(n)
@@ -0,0 +1,49 @@
+import asyncio
+
+from contextlib import AsyncExitStack, asynccontextmanager
+
+
+class KeyedLocks:
+    """
+    An asyncio lock for each key, created when first needed and dropped once
+    nothing holds or waits on it, so unrelated keys never wait on each other.
+    """
+    def __init__(self):
+        self.locks = {}
+        self.waiting = {}
+
+
+    @asynccontextmanager
+    async def hold(self, key):
+        """
+        Holds the lock for a key.
+        """
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+            self.waiting[key] = 0
+
+        lock = self.locks[key]
+        self.waiting[key] += 1
+
+        try:
+            async with lock:
+                yield
+        finally:
+            self.waiting[key] -= 1
+
+            if self.waiting[key] == 0:
+                del self.locks[key]
+                del self.waiting[key]
+
+
+    @asynccontextmanager
+    async def hold_all(self, keys):
+        """
+        Holds the locks for several keys. They are always taken in sorted order
+        so two holders can't deadlock waiting on each other.
+        """
+        async with AsyncExitStack() as stack:
+            for key in sorted(set(keys)):
+                await stack.enter_async_context(self.hold(key))
+
+            yield
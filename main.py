@@ -1,17 +1,39 @@
 import discord
-import replit
 import os
-import re
+import time
 
 import threading
+import traceback
 import asyncio
 
-from discord.ext import commands
+from collections import Counter
+from datetime import timezone
+from discord.ext import commands, tasks
 from dotenv import load_dotenv
 
-from errors import ErrorMessageGenerator
+import metrics
 
-from ping import keep_running
+from backfill import Checkpoints, backfill, checkpoint_name
+from counters import CounterBuffer
+from errors import ErrorMessageGenerator
+from guilds import GuildState, is_legacy_key, parse_user_key, user_key
+from history import WordHistory
+from ingest import MessageQueue
+from journal import IncrementLog
+from locks import KeyedLocks
+from members import MemberIndex
+from metrics import MeasuredStore
+from recent import RecentMatches, diff
+from replies import ReplyQueue
+from reports import iterate, send_report
+from shards import ShardHub, ShardLink
+from store import MemoryStore, ReplitStore, SQLiteStore
+from words import SubstringIndex, WordIndex, collapse
+
+from ping import keep_running, port
+
+# When the process started, for timing how long startup takes
+STARTED = time.perf_counter()
 
 # Constants
 CMD_IDENTIFIER = '$'
@@ -35,36 +57,155 @@ CMD_ENABLE = ['enable', 'en']
 
 CMD_SET_REPLY_CHANNEL = ['setreplychannel', 'src']
 
+CMD_MIGRATE_DATABASE = ['migratedatabase', 'md']
+
+CMD_TOP_USERS = ['topusers', 'tu']
+CMD_TOP_USERS_FOR_WORD = ['topusersforword', 'tuw']
+CMD_TOP_WORDS = ['topwords', 'tw']
+
+CMD_BACKFILL = ['backfill', 'bf']
+
+CMD_COUNT_SINCE = ['countsince', 'cs']
+
+LEADERBOARD_SIZE = 10
+LEADERBOARD_MAX_SIZE = 25
+
 DB_NAME = 'USERS'
 
+LOG_SYNC_INTERVAL = 1
+
+WINDOW_UNITS = {'h': 3600, 'd': 86400, 'w': 604800, 'm': 2592000, 'y': 31536000}
+
+REPLY_WINDOW = 0.5
+
+RECENT_MESSAGES = 10000
+
+PREFETCH_CONCURRENCY = 16
+LIST_USERS_MAX_DELAY = 60
+
+BACKFILL_BATCH_SIZE = 500
+BACKFILL_PAUSE = 1.0
+BACKFILL_PROGRESS = 5000
+
 ROLE_ADMIN = 'Node'
 
 # Dynamics
 debug = True
-enable = True
 
 # Load .env
 load_dotenv(os.path.join('venv/', '.env'))
 
+# Sharding, set up with the WORKERS and SHARD_COUNT settings. Each worker
+# process is given its SHARD_IDS and WORKER_ID when it is started.
+WORKERS = int(os.getenv('WORKERS', 1))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', WORKERS if WORKERS > 1 else 0))
+SHARD_IDS = os.getenv('SHARD_IDS')
+WORKER_ID = int(os.getenv('WORKER_ID', 0))
+
+# Matching, set up with MATCH_MODE ('token' or 'substring'), MATCH_BOUNDARY
+# and MATCH_FOLDING ('lower' or 'unicode')
+MATCH_MODE = os.getenv('MATCH_MODE', 'token')
+MATCH_BOUNDARY = os.getenv('MATCH_BOUNDARY', 'false').lower() == 'true'
+MATCH_FOLDING = os.getenv('MATCH_FOLDING', 'lower')
+
+# Writing buffered word counts to the database, every COUNTER_FLUSH_INTERVAL
+# seconds or once COUNTER_FLUSH_SIZE increments are buffered
+COUNTER_FLUSH_INTERVAL = float(os.getenv('COUNTER_FLUSH_INTERVAL', 30))
+COUNTER_FLUSH_SIZE = int(os.getenv('COUNTER_FLUSH_SIZE', 100))
+
+# Checking messages off the event loop's hot path
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', 1000))
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 4))
+INGEST_POLICY = os.getenv('INGEST_POLICY', 'degrade')
+
+# Link to the other worker processes when running more than one
+shard_link = None
+
+class WordCheckerBot(commands.AutoShardedBot if SHARD_COUNT else commands.Bot):
+    async def close(self):
+        """
+        Sends any queued replies, writes any buffered word counts and closes
+        the database before the bot shuts down.
+        """
+        await ingest.close()
+        await replies.flush()
+        await flush_counts()
+        await history.save()
+        await increment_log.sync()
+        increment_log.close()
+        await database.close()
+        await super().close()
+
+
 # Create client
 intents = discord.Intents.default()
 intents.members = True
-client = commands.Bot(command_prefix=CMD_IDENTIFIER, intents=intents)
 
-# Database setup
-db = replit.Database(os.getenv('DB_URL'))
-if DB_NAME not in db.keys():
-    db[DB_NAME] = {}
+if SHARD_COUNT:
+    shard_ids = [int(shard_id) for shard_id in SHARD_IDS.split(',')] if SHARD_IDS else None
+    client = WordCheckerBot(command_prefix=CMD_IDENTIFIER, intents=intents, shard_count=SHARD_COUNT, shard_ids=shard_ids)
+else:
+    client = WordCheckerBot(command_prefix=CMD_IDENTIFIER, intents=intents)
+
+# Database setup, selected with the STORE setting
+STORE = os.getenv('STORE', 'replit')
+
+if STORE == 'memory':
+    database = MemoryStore()
+elif STORE == 'sqlite':
+    database = SQLiteStore(os.getenv('SQLITE_PATH', 'venv/words.db'))
+else:
+    database = ReplitStore(os.getenv('DB_URL'), DB_NAME)
+
+database = MeasuredStore(database)
+
+# Tracked words indexed by their canonical form. In substring mode words
+# are also found inside other text, like 'lmao' in 'lmaoooXD'
+if MATCH_MODE == 'substring':
+    word_index = SubstringIndex(MATCH_BOUNDARY, MATCH_FOLDING)
+else:
+    word_index = WordIndex()
+
+# Word count increments waiting to be written to the database, logged to a
+# file for each worker so they survive a restart
+increment_log = IncrementLog(os.getenv('INCREMENT_LOG', 'venv/increments') + '.{0}.log'.format(WORKER_ID))
+counters = CounterBuffer(COUNTER_FLUSH_SIZE, increment_log)
 
-database = db[DB_NAME]
+# Words matched in recent messages, for counting edits and deletes
+recent_matches = RecentMatches(RECENT_MESSAGES)
 
-# Purge stuff
-try_purge_words = False
-try_purge_users = False
-try_disable_bot = False
+# When words were said, in hourly, daily and monthly buckets
+history = WordHistory(os.getenv('HISTORY_PATH', 'venv/history') + '.{0}.json'.format(WORKER_ID))
+
+# Server members by username and ID, built when the bot is ready
+member_index = MemberIndex()
+
+# Settings, pending confirmations and leaderboards for each server
+guild_states = {}
+
+# Users in the database whose words haven't been indexed yet. They are
+# indexed the first time they are needed, and in the background at startup.
+# listed is set once they are known, and prefetched once all are indexed
+unindexed_users = set()
+listed = asyncio.Event()
+prefetched = asyncio.Event()
+
+# Locks held while changing a user's words or counts
+user_locks = KeyedLocks()
+
+# Where each history backfill got to, in a file for each worker process
+checkpoints = Checkpoints(os.getenv('BACKFILL_PATH', 'venv/backfill') + '.{0}.json'.format(WORKER_ID))
 
 # Message stuff
 channel = None
+replies = ReplyQueue(REPLY_WINDOW)
+metrics.REPLY_QUEUE_DEPTH.function = replies.depth
+
+# Messages from tracked users waiting to be checked
+ingest = MessageQueue(lambda ctx: handle_message(ctx), lambda *record: count_message(*record), INGEST_QUEUE_SIZE,
+                      INGEST_WORKERS, INGEST_POLICY,
+                      os.getenv('SPILL_PATH', 'venv/spill') + '.{0}.jsonl'.format(WORKER_ID))
+metrics.INGEST_QUEUE_DEPTH.function = ingest.depth
 
 # Error message stuff
 emg = ErrorMessageGenerator('venv/error_messages.txt')
@@ -85,44 +226,171 @@ async def user_exists_in_server(ctx, username):
     """
     Return True if the given username exists in the server. Otherwise, return False.
     """
-    members = [member.name + '#' + member.discriminator for member in client.get_all_members()]
+    return await resolve_user(ctx, username) is not None
 
-    if username in members:
-        return True
-    return False
 
+async def user_exists_in_db(ctx, key):
+    """
+    Return True if the user key exists in the database. Otherwise, return False.
+    """
+    return await database.has_user(key)
 
-async def user_exists_in_db(ctx, username):
+
+async def resolve_user(ctx, username):
     """
-    Return True if the username exists in the database. Otherwise, return False.
+    Returns the key for the member of the server with the given username or
+    ID. A user who has left the server is still found by their ID or last
+    known username if they are tracked. If there is no such user, return
+    None.
     """
-    if username not in database.keys():
-        return False
+    user_id = member_index.get_id(username)
+
+    if user_id is None and username.isdigit():
+        user_id = int(username)
+
+    if user_id is None:
+        user_id = member_index.get_former_id(username)
+
+    if user_id is None:
+        return None
+
+    key = user_key(ctx.guild.id, user_id)
+
+    if ctx.guild.get_member(user_id) is None and not await user_exists_in_db(ctx, key):
+        return None
+    return key
+
+
+def display_name(key):
+    """
+    Returns the username to show for a user key.
+    """
+    guild_id, user_id = parse_user_key(key)
+    return member_index.get_name(user_id) or str(user_id)
+
+
+def guild_state(guild_id):
+    """
+    Returns the settings and state of a server.
+    """
+    if guild_id not in guild_states:
+        guild_states[guild_id] = GuildState()
+    return guild_states[guild_id]
+
+
+def leaderboard_for(key):
+    """
+    Returns the leaderboard of the server a user key belongs to.
+    """
+    guild_id, user_id = parse_user_key(key)
+    return guild_state(guild_id).leaderboard
+
+
+async def guild_users(guild_id):
+    """
+    Returns the keys of every tracked user in a server.
+    """
+    return await database.users(user_key(guild_id, ''))
+
+
+async def guild_counts(guild_id):
+    """
+    Yields the (key, word, count) rows of every tracked user in a server.
+    """
+    async for row in database.counts(prefix=user_key(guild_id, '')):
+        yield row
+
+
+@client.check
+async def guild_enabled(ctx):
+    """
+    Only lets commands run in servers, and only Enable while the bot is
+    disabled in the server.
+    """
+    if ctx.guild is None:
+        raise commands.NoPrivateMessage()
+
+    if not guild_state(ctx.guild.id).enabled and ctx.command.name != 'Enable':
+        raise commands.DisabledCommand()
+
     return True
 
 
 @client.command('SetReplyChannel', aliases=CMD_SET_REPLY_CHANNEL)
 @commands.has_role(ROLE_ADMIN)
-async def set_reply_channel(ctx, id):
+async def set_reply_channel(ctx, id: int):
     """
     Sets the channel id for the bot to reply in.
     """
+    guild_state(ctx.guild.id).channel = await get_reply_channel(id)
+    broadcast('reply_channel', ctx.guild.id, id)
+
+
+async def get_reply_channel(id):
+    """
+    Returns the channel with the given id. The channel is fetched from Discord
+    if it is in a server on another worker's shards.
+    """
+    return client.get_channel(id) or await client.fetch_channel(id)
+
+
+def broadcast(kind, *args):
+    """
+    Tells the other worker processes about a change, if there are any.
+    """
+    if shard_link is not None:
+        shard_link.broadcast(kind, *args)
+
+
+def reply_channel(ctx):
+    """
+    Returns the channel to reply in: the server's reply channel if one was
+    set, the global channel if it is in this server, or else the channel the
+    message came from.
+    """
     global channel
 
-    channel = client.get_channel(id)
+    state = guild_state(ctx.guild.id)
+
+    if state.channel != None:
+        return state.channel
+    if channel != None and channel.guild == ctx.guild:
+        return channel
+    return ctx.channel
 
 
 async def try_reply(ctx, message):
     """
     Tries to send a message to the specified global channel. If that doesn't
-    exist, send message to the reply channel.
+    exist, send message to the reply channel. The message is queued and merged
+    with other replies to the same channel, so this returns right away.
     """
-    global channel
-    
-    if channel != None:
-        await channel.send(message)
-    else:
-        await ctx.send(message)
+    replies.send(reply_channel(ctx), message)
+
+
+async def try_reply_report(ctx, title, columns, rows, format_row, filename):
+    """
+    Sends a report to the same channel as try_reply, as pages of embeds or as
+    a CSV file if it is too long. Returns False if there was nothing to report.
+    """
+    return await send_report(replies, reply_channel(ctx), title, columns, rows, format_row, filename)
+
+
+async def with_names(rows):
+    """
+    Yields (key, word, count) rows with each key replaced by the username to
+    show, so reports never show a key.
+    """
+    async for key, word, count in rows:
+        yield display_name(key), word, count
+
+
+def format_word_count(row):
+    """
+    Formats a (username, word, count) row for a word count report.
+    """
+    username, word, count = row
+    return '{0} has said {1}, {2} times.'.format(username, word, count)
 
 ### Word commands
 
@@ -136,26 +404,34 @@ async def add_word(ctx, username, *word_list):
     if len(word_list) == 0:
         raise commands.errors.MissingRequiredArgument
 
-    if not await user_exists_in_db(ctx, username):
-        await try_reply(ctx, 'Unable to add word. {0} is not in the database.'.format(username))
+    key = await resolve_user(ctx, username)
 
-    for word in word_list:
-        word = ''.join(word).lower().replace(' ', '')
-        
-        words = database[username]
+    async with user_locks.hold(key):
+        if key is None or not await user_exists_in_db(ctx, key):
+            await try_reply(ctx, 'Unable to add word. {0} is not in the database.'.format(username))
+            return
 
-        # Construct regex
-        word_as_chars = [char for char in word]
-        regex = '+'.join(word_as_chars)
-        
-        for w in words.keys():
-            if re.match(regex, w):
-                await try_reply(ctx, '{0} is already in the database.'.format(w))
+        await index_user(key)
+
+        for word in word_list:
+            word = ''.join(word).lower().replace(' ', '')
+
+            if not collapse(word):
+                await try_reply(ctx, '{0} can\'t be tracked, as it is only punctuation.'.format(word))
                 continue
-        
-        words[word] = 0
+            
+            # Any spelling of an existing word collapses to the same canonical form
+            existing = word_index.lookup(key, word)
+            if existing is not None:
+                await try_reply(ctx, '{0} is already in the database.'.format(existing))
+                continue
+            
+            await database.add_word(key, word)
+            word_index.add(key, word)
+            await checkpoints.track(key, word, ctx.message.id)
+            broadcast('reload_user', key)
 
-        await try_reply(ctx, '{0} successfuly added to the database.'.format(word))
+            await try_reply(ctx, '{0} successfuly added to the database.'.format(word))
 
 
 @client.command(name='RemoveWord', aliases=CMD_REM_WORD)
@@ -168,19 +444,31 @@ async def remove_word(ctx, username, *word_list):
     if len(word_list) == 0:
         raise commands.errors.MissingRequiredArgument
 
-    if not await user_exists_in_db(ctx, username):
-        await try_reply(ctx, '{0} is not in the database.'.format(username))
-        return
+    key = await resolve_user(ctx, username)
 
-    for word in word_list:
-        word = word.lower().replace(' ', '')
+    async with user_locks.hold(key):
+        if key is None or not await user_exists_in_db(ctx, key):
+            await try_reply(ctx, '{0} is not in the database.'.format(username))
+            return
 
-        if word not in database[username].keys():
-            await try_reply(ctx, 'Not tracking the word {0} for user {1}.'.format(word, username))
-            continue
+        await index_user(key)
+
+        for word in word_list:
+            word = word.lower().replace(' ', '')
+
+            if word not in await database.words(key):
+                await try_reply(ctx, 'Not tracking the word {0} for user {1}.'.format(word, username))
+                continue
 
-        del database[username][word]
-        await try_reply(ctx, 'Removed {0} from {1}\'s database.'.format(word, username))
+            await database.remove_word(key, word)
+            word_index.remove(key, word)
+            leaderboard_for(key).remove_word(key, word)
+            counters.discard(key, word)
+            history.remove_word(key, word)
+            recent_matches.forget_word(key, word)
+            await checkpoints.untrack(key, word)
+            broadcast('reload_user', key)
+            await try_reply(ctx, 'Removed {0} from {1}\'s database.'.format(word, username))
 
 
 @client.command(name='GetWords', aliases=CMD_GET_WORDS)
@@ -190,12 +478,14 @@ async def get_words(ctx, username):
     it as a discord message.
     """
     global database, channel_id
+
+    key = await resolve_user(ctx, username)
     
-    if not await user_exists_in_db(ctx, username):
+    if key is None or not await user_exists_in_db(ctx, key):
         await try_reply(ctx, 'User {0} does not exist in the database.'.format(username))
         return
 
-    words = list(database[username].keys())
+    words = list(await database.words(key))
     length = len(words)
 
     if length == 0:
@@ -205,16 +495,8 @@ async def get_words(ctx, username):
         await try_reply(ctx, 'The only word in the database is: {0}'.format(words[0]))
         return
 
-    s = ''
-    for i in range(0, length):
-        s += words[i]
-        
-        if i == length - 2:
-            s += ', and '
-        elif i != length - 1:
-            s += ', '
-    
-    await try_reply(ctx, 'The words currently in the database are: {0}.'.format(s))
+    await try_reply_report(ctx, 'The words currently in the database for {0}'.format(username), ['word'],
+                           iterate((word,) for word in words), lambda row: row[0], 'words.csv')
 
 
 @client.command(name='PurgeWords', aliases=CMD_PURGE_WORDS)
@@ -222,21 +504,33 @@ async def purge_words(ctx, username):
     """
     Removes all words from the database.
     """
-    global try_purge_words, channel_id
+    global channel_id
 
-    if not await user_exists_in_db(ctx, username):
+    state = guild_state(ctx.guild.id)
+    key = await resolve_user(ctx, username)
+
+    if key is None or not await user_exists_in_db(ctx, key):
         await try_reply(ctx, 'User {0} does not exist in the database.'.format(username))
         return
 
-    if not try_purge_words:
-        try_purge_words = True
+    if not state.try_purge_words:
+        state.try_purge_words = True
         await try_reply(ctx, 'Do you really want to purge all words from the database? Use the command again if you really want to.')
         
         return
 
-    database[username] = {}
+    async with user_locks.hold(key):
+        await index_user(key)
+        await database.clear_words(key)
+        word_index.remove_user(key)
+        leaderboard_for(key).remove_user(key)
+        counters.discard(key)
+        history.remove_user(key)
+        recent_matches.forget_word(key)
+        await checkpoints.untrack(key)
+        broadcast('reload_user', key)
     
-    try_purge_words = False
+    state.try_purge_words = False
 
     await try_reply(ctx, 'Purged all words for user: {0}.'.format(username))
 
@@ -252,19 +546,19 @@ async def add_user(ctx, *user_list):
     if len(user_list) == 0:
         raise commands.errors.MissingRequiredArgument
 
-    members = [member.name + '#' + member.discriminator for member in client.get_all_members()]
-    users = database.keys()
-
     for user in user_list:
-        if user not in members:
+        key = await resolve_user(ctx, user)
+
+        if key is None:
             await try_reply(ctx, 'Could not find member with that username.')
             continue
 
-        if user in users:
-            await try_reply(ctx, 'User {0} is already in the database.'.format(user))
-            continue
+        async with user_locks.hold(key):
+            if await user_exists_in_db(ctx, key):
+                await try_reply(ctx, 'User {0} is already in the database.'.format(user))
+                continue
 
-        database[user] = {}
+            await database.add_user(key)
         
         await try_reply(ctx, 'Now tracking user {0}.'.format(user))
 
@@ -280,14 +574,33 @@ async def remove_user(ctx, *user_list):
         raise commands.errors.MissingRequiredArgument
 
     for user in user_list:
-        if not await user_exists_in_db(ctx, user):
+        key = await resolve_user(ctx, user)
+
+        if key is None or not await user_exists_in_db(ctx, key):
             await try_reply(ctx, 'User {0} does not exist in the database.'.format(user))
             continue
 
-        database.pop(user)
+        async with user_locks.hold(key):
+            await index_user(key)
+            await remove_tracked_user(key)
+
         await try_reply(ctx, 'Successully removed user {0} from the database.'.format(user))
 
 
+async def remove_tracked_user(key):
+    """
+    Removes a user from the database, word index, leaderboard and counters.
+    """
+    await database.remove_user(key)
+    word_index.remove_user(key)
+    leaderboard_for(key).remove_user(key)
+    counters.discard(key)
+    history.remove_user(key)
+    recent_matches.forget_word(key)
+    await checkpoints.untrack(key)
+    broadcast('reload_user', key)
+
+
 @client.command(name='GetUsers', aliases=CMD_GET_USERS)
 async def get_users(ctx):
     """
@@ -295,7 +608,7 @@ async def get_users(ctx):
     """
     global database, channel_id
 
-    users = list(database.keys())
+    users = [display_name(key) for key in await guild_users(ctx.guild.id)]
     length = len(users)
 
     if length == 0:
@@ -303,33 +616,31 @@ async def get_users(ctx):
     elif length == 1:
         await try_reply(ctx, 'The only user in the database is: {0}.'.format(users[0]))
     else:
-        s = ''
-        for i in range(0, len(users)):
-            s += users[i]
-            
-            if i == length - 2:
-                s += ', and '
-            elif i != length - 1:
-                s += ', '
-
-        await try_reply(ctx, 'The users currently in the database are: {0}.'.format(s))
+        await try_reply_report(ctx, 'The users currently in the database', ['user'],
+                               iterate((user,) for user in users), lambda row: row[0], 'users.csv')
 
 
 @client.command(name='PurgeUsers', aliases=CMD_PURGE_USERS)
 async def purge_users(ctx):
     """
-    Removes all users from the database.
+    Removes all users in the server from the database.
     """
-    global try_purge_users, database, channel_id
+    global database, channel_id
+
+    state = guild_state(ctx.guild.id)
 
-    if not try_purge_users:
-        try_purge_users = True
+    if not state.try_purge_users:
+        state.try_purge_users = True
         await try_reply(ctx, 'Do you really want to purge all users from the database? Type the command again if you really want to.')
         
         return
 
-    database = {}
-    try_purge_users = False
+    for key in await guild_users(ctx.guild.id):
+        async with user_locks.hold(key):
+            await remove_tracked_user(key)
+
+    state.leaderboard.clear()
+    state.try_purge_users = False
 
     await try_reply(ctx, 'Purged all users from the database.')
 
@@ -341,59 +652,334 @@ async def get_user_words_count(ctx, username):
     """
     global database, channel_id
 
-    if not await user_exists_in_db(ctx, username):
+    key = await resolve_user(ctx, username)
+
+    if key is None or not await user_exists_in_db(ctx, key):
         await try_reply(ctx, 'User {0} does not exist in the database.'.format(username))
         return
 
-    output_msg = ''
+    await flush_counts()
 
-    for word in database[username].keys():
-        output_msg += '{0} has said {1}, {2} times.\n'.format(username, word, database[username][word])
-    
-    await try_reply(ctx, output_msg)
+    if not await try_reply_report(ctx, 'Word counts for {0}'.format(username), ['user', 'word', 'count'],
+                                  with_names(database.counts(key)), format_word_count, 'word_counts.csv'):
+        await try_reply(ctx, 'There are currently no words in the database.')
 
 
 @client.command(name='AllUserWordsCount', aliases=CMD_GET_ALL_USER_WORDS_COUNT)
 async def get_all_user_words_count(ctx):
     """
-    Lists the word count for all users.
+    Lists the word count for all users in the server.
     """
     global database, channel_id
 
-    output_msg = ''
+    await flush_counts()
 
-    for username in database.keys():
-        for word in database[username].keys():
-            output_msg += '{0} has said {1}, {2} times.\n'.format(username, word, database[username][word])
-        
-    await try_reply(ctx, output_msg)
+    if not await try_reply_report(ctx, 'Word counts for all users', ['user', 'word', 'count'],
+                                  with_names(guild_counts(ctx.guild.id)), format_word_count, 'word_counts.csv'):
+        await try_reply(ctx, 'There are currently no words in the database.')
 
 
 @client.command(name='Enable', aliases=CMD_ENABLE)
 @commands.has_role(ROLE_ADMIN)
 async def activate_bot(ctx):
     """
-    Enables/Disables the bot.
+    Enables/Disables the bot in the server.
     """
-    global channel_id, enable
+    global channel_id
 
-    enable = not enable
+    state = guild_state(ctx.guild.id)
+    state.enabled = not state.enabled
+    broadcast('enable', ctx.guild.id, state.enabled)
 
-    if enable:
-        for cmd in client.commands:
-            if cmd.name == 'Enable':
-                continue
-            cmd.enabled = True
+    if state.enabled:
         await try_reply(ctx, 'I am now enabled.')
     else:
-        for cmd in client.commands:
-            if cmd.name == 'Enable':
-                continue
-            cmd.enabled = False
         await try_reply(ctx, 'I am now disabled.')
 
+
+@client.command(name='MigrateDatabase', aliases=CMD_MIGRATE_DATABASE)
+@commands.has_role(ROLE_ADMIN)
+async def migrate_database(ctx):
+    """
+    Splits the old single USERS entry of the database into one entry per user,
+    and moves users kept by username to this server, keyed by their ID.
+    """
+    global database, channel_id
+
+    # Every user is indexed again afterwards, so let the startup indexing
+    # finish first
+    await prefetched.wait()
+    await flush_counts()
+
+    migrated = await database.migrate()
+    migrated += await migrate_usernames(ctx.guild)
+
+    if migrated == 0:
+        await try_reply(ctx, 'There is nothing to migrate.')
+        return
+
+    await load_words()
+    broadcast('reload_all')
+
+    await try_reply(ctx, 'Migrated {0} users into their own database entries.'.format(migrated))
+
+
+async def migrate_usernames(guild):
+    """
+    Moves every user kept by name#discriminator who is a member of the server
+    to a key made from the server and their ID, keeping their counts. Returns
+    the number of users moved.
+    """
+    migrated = 0
+
+    for username in await database.users():
+        if not is_legacy_key(username):
+            continue
+
+        user_id = member_index.get_id(username)
+        if user_id is None or guild.get_member(user_id) is None:
+            continue
+
+        key = user_key(guild.id, user_id)
+
+        async with user_locks.hold_all([username, key]):
+            words = await database.words(username)
+
+            await database.add_user(key)
+            for word in words:
+                await database.add_word(key, word)
+            await database.increment({key: words})
+
+            await database.remove_user(username)
+
+        migrated += 1
+
+    return migrated
+
+### Leaderboard commands
+
+def format_ranking(ranking):
+    """
+    Formats a list of (name, count) pairs as numbered lines.
+    """
+    return '\n'.join('{0}. {1}: {2}'.format(i, name, count) for i, (name, count) in enumerate(ranking, 1))
+
+
+@client.command(name='TopUsers', aliases=CMD_TOP_USERS)
+async def top_users(ctx, n: int = LEADERBOARD_SIZE):
+    """
+    Lists the users in the server who have said their tracked words the most.
+    """
+    # Users are only on the leaderboard once they have been indexed
+    await prefetched.wait()
+
+    leaderboard = guild_state(ctx.guild.id).leaderboard
+    ranking = leaderboard.top_users(min(max(n, 1), LEADERBOARD_MAX_SIZE))
+
+    if len(ranking) == 0:
+        await try_reply(ctx, 'Nobody has said any of their words yet.')
+        return
+
+    ranking = [(display_name(key), count) for key, count in ranking]
+    await try_reply(ctx, 'Users who have said their words the most:\n' + format_ranking(ranking))
+
+
+@client.command(name='TopUsersForWord', aliases=CMD_TOP_USERS_FOR_WORD)
+async def top_users_for_word(ctx, word, n: int = LEADERBOARD_SIZE):
+    """
+    Lists the users in the server who have said a word the most.
+    """
+    # Users are only on the leaderboard once they have been indexed
+    await prefetched.wait()
+
+    leaderboard = guild_state(ctx.guild.id).leaderboard
+    ranking = leaderboard.top_users_for_word(word, min(max(n, 1), LEADERBOARD_MAX_SIZE))
+
+    if len(ranking) == 0:
+        await try_reply(ctx, 'Nobody has said {0} yet.'.format(word))
+        return
+
+    ranking = [(display_name(key), count) for key, count in ranking]
+    await try_reply(ctx, 'Users who have said {0} the most:\n'.format(word) + format_ranking(ranking))
+
+
+@client.command(name='TopWords', aliases=CMD_TOP_WORDS)
+async def top_words(ctx, username, n: int = LEADERBOARD_SIZE):
+    """
+    Lists the words a user has said the most.
+    """
+    key = await resolve_user(ctx, username)
+    ranking = []
+
+    if key is not None:
+        await index_user(key)
+        ranking = leaderboard_for(key).top_words(key, min(max(n, 1), LEADERBOARD_MAX_SIZE))
+
+    if len(ranking) == 0:
+        await try_reply(ctx, '{0} hasn\'t said any of their words yet.'.format(username))
+        return
+
+    await try_reply(ctx, 'Words {0} has said the most:\n'.format(username) + format_ranking(ranking))
+
+### History commands
+
+def parse_window(window):
+    """
+    Returns the number of seconds in a window such as 12h, 7d, 2w, 3m or 1y.
+    If the window isn't valid, return None.
+    """
+    amount, unit = window[:-1], window[-1:].lower()
+
+    if not amount.isdigit() or unit not in WINDOW_UNITS:
+        return None
+    return int(amount) * WINDOW_UNITS[unit]
+
+
+@client.command(name='CountSince', aliases=CMD_COUNT_SINCE)
+async def count_since(ctx, username, window, *word_list):
+    """
+    Lists how many times a user has said their words, or the given words,
+    in a recent window of time such as 24h, 7d, 2w, 3m or 1y.
+    """
+    seconds = parse_window(window)
+
+    if seconds is None:
+        await try_reply(ctx, '{0} is not a window of time. Try something like 24h, 7d, 2w, 3m or 1y.'.format(window))
+        return
+
+    key = await resolve_user(ctx, username)
+
+    if key is None or not await user_exists_in_db(ctx, key):
+        await try_reply(ctx, 'User {0} does not exist in the database.'.format(username))
+        return
+
+    await index_user(key)
+
+    words = list(await database.words(key))
+
+    if len(words) == 0:
+        await try_reply(ctx, 'There are currently no words in the database.')
+        return
+
+    # Words are given as they were said, so find the tracked word each is a
+    # spelling of
+    if word_list:
+        words = []
+        for word in word_list:
+            tracked = word_index.lookup(key, word)
+
+            if tracked is None:
+                await try_reply(ctx, '{0} is not in the database for user {1}.'.format(word, username))
+                continue
+
+            words.append(tracked)
+
+    rows = [(key, word, history.count(key, word, seconds)) for word in words]
+
+    await try_reply_report(ctx, 'Word counts for {0} in the last {1}'.format(username, window),
+                           ['user', 'word', 'count'], with_names(iterate(rows)), format_word_count, 'word_counts.csv')
+
+### Backfill commands
+
+@client.command(name='Backfill', aliases=CMD_BACKFILL)
+@commands.has_role(ROLE_ADMIN)
+async def backfill_channels(ctx, username, channel_list: commands.Greedy[discord.TextChannel], *word_list):
+    """
+    Counts a user's words, or the given words, in the history of channels,
+    up to when each word was added, as later messages were counted as they
+    were sent. Words added before that was kept are counted up to when the
+    command was used. A set of words is only backfilled once in each
+    channel, and a backfill that was interrupted carries on from where it
+    stopped when the command is used again.
+    """
+    if len(channel_list) == 0:
+        raise commands.errors.MissingRequiredArgument
+
+    key = await resolve_user(ctx, username)
+
+    if key is None or not await user_exists_in_db(ctx, key):
+        await try_reply(ctx, 'User {0} does not exist in the database.'.format(username))
+        return
+
+    await index_user(key)
+
+    words = set()
+    for word in word_list or list(await database.words(key)):
+        tracked = word_index.lookup(key, word)
+
+        if tracked is None:
+            await try_reply(ctx, '{0} is not in the database for user {1}.'.format(word, username))
+            return
+
+        words.add(tracked)
+
+    if len(words) == 0:
+        await try_reply(ctx, 'There are currently no words in the database.')
+        return
+
+    state = guild_state(ctx.guild.id)
+
+    if state.backfilling:
+        await try_reply(ctx, 'A backfill is already running in this server.')
+        return
+
+    # The ID of the message each word was added in, where its backfill stops
+    since = {word: checkpoints.tracked_since(key, word) or ctx.message.id for word in words}
+
+    state.backfilling = True
+    buffer = CounterBuffer()
+
+    # When each counted word was said, added to the history only once its
+    # count is written, so a resumed backfill never adds it twice
+    said = []
+
+    def count(message):
+        if message.author.id == parse_user_key(key)[1] and not message.content.startswith(CMD_IDENTIFIER):
+            for word in match_words(key, message.content):
+                if word in words and message.id < since[word]:
+                    buffer.increment(key, word)
+                    said.append((word, message.created_at.replace(tzinfo=timezone.utc).timestamp()))
+
+    async def flush():
+        async with user_locks.hold_all(buffer.pending.keys()):
+            flushed = await buffer.flush(database)
+
+        for word, timestamp in said:
+            history.increment(key, word, 1, timestamp)
+        said.clear()
+
+        if flushed:
+            for word, amount in flushed.get(key, {}).items():
+                leaderboard_for(key).increment(key, word, amount)
+            broadcast('counted', flushed)
+
+    try:
+        for channel in channel_list:
+            if channel.guild != ctx.guild:
+                await try_reply(ctx, '{0} is not in this server.'.format(channel.mention))
+                continue
+
+            async def progress(read):
+                await try_reply(ctx, 'Backfilled {0} messages in {1} so far.'.format(read, channel.mention))
+
+            name = checkpoint_name(channel.id, key, words)
+            read = await backfill(channel, checkpoints, name, max(since.values()), count, flush, BACKFILL_BATCH_SIZE,
+                                  BACKFILL_PAUSE, progress, BACKFILL_PROGRESS)
+
+            await try_reply(ctx, 'Finished backfilling {0}, read {1} messages.'.format(channel.mention, read))
+    finally:
+        state.backfilling = False
+
 ### ### ###
 
+def match_words(author, content):
+    """
+    Returns the tracked words of the user with the given key in a message,
+    once for each time they were said.
+    """
+    return word_index.match(author, content)
+
+
 async def check_message(ctx):
     """
     Called when a user sends a discord message. Check if the message author
@@ -403,34 +989,325 @@ async def check_message(ctx):
     """
     global channel_id
 
-    author = str(ctx.author)
-    users = database.keys()
-    words_msg = ctx.content.split()
+    if ctx.guild is None:
+        return
+
+    author = user_key(ctx.guild.id, ctx.author.id)
+    matches = await count_message(ctx.guild.id, ctx.author.id, ctx.id, ctx.content)
 
-    if author not in users:
+    if not matches:
         return
 
-    words_in_database = database[author]
+    user = await database.words(author)
 
     output_msg = ''
 
-    for word in words_in_database:
-        w = word.replace(' ', '').lower()
+    for word in matches:
+        count = counters.count(author, word, user.get(word, 0))
+        output_msg += '{0} has said {1} {2} times.\n'.format(ctx.author.mention, word, count)
 
-        word_as_char = [char for char in w]
-        regex = '+'.join(word_as_char) + '+'
+    await try_reply(ctx, output_msg)
 
-        for word_input in words_msg:
-            if not re.match(regex, word_input):
-                continue
-        
-            user = database[author]
 
-            user[word] += 1
+async def count_message(guild_id, author_id, message_id, content):
+    """
+    Counts the tracked words in a message without replying, and returns
+    them.
+    """
+    author = user_key(guild_id, author_id)
 
-            output_msg += '{0} has said {1} {2} times.\n'.format(ctx.author.mention, word, user[word])
-    
-    await try_reply(ctx, output_msg)
+    if author in unindexed_users or not listed.is_set():
+        await index_user(author)
+
+    matches = match_words(author, content)
+
+    # Remember messages from tracked users, even without matches, in case
+    # they are edited to add a word
+    if word_index.tracks(author):
+        recent_matches.remember(message_id, author, matches, time.time())
+
+    if not matches:
+        return matches
+
+    flush = False
+    leaderboard = leaderboard_for(author)
+
+    for word in matches:
+        flush = counters.increment(author, word) or flush
+        leaderboard.increment(author, word)
+        history.increment(author, word)
+
+    metrics.MATCHES.inc(len(matches))
+
+    if flush:
+        await flush_counts()
+
+    return matches
+
+
+def is_tracked(key):
+    """
+    Return True if a user has tracked words, or is in the database but hasn't
+    been indexed yet. Until the users have been listed any user might be
+    tracked, so return True. Otherwise, return False.
+    """
+    return not listed.is_set() or word_index.tracks(key) or key in unindexed_users
+
+
+async def handle_message(ctx):
+    """
+    Called by the ingest workers for each queued message.
+    """
+    start = time.perf_counter()
+    await check_message(ctx)
+    metrics.CHECK_LATENCY.observe(time.perf_counter() - start)
+
+
+async def recount_message(message_id, content):
+    """
+    Called when a recent message from a tracked user is edited or deleted.
+    Only the change between the words matched before and the words matched
+    now is counted, and deleted messages match no words. Words that are no
+    longer tracked are left alone.
+    """
+    if content is None:
+        entry = recent_matches.forget(message_id)
+    else:
+        entry = recent_matches.get(message_id)
+
+    if entry is None:
+        return
+
+    author, old, timestamp = entry
+    new = Counter()
+
+    if content is not None:
+        new = Counter(match_words(author, content))
+        recent_matches.remember(message_id, author, new, timestamp)
+
+    flush = False
+    leaderboard = leaderboard_for(author)
+
+    for word, amount in diff(old, new).items():
+        if word_index.lookup(author, word) != word:
+            continue
+
+        flush = counters.increment(author, word, amount) or flush
+        leaderboard.increment(author, word, amount)
+        history.increment(author, word, amount, timestamp)
+
+    if flush:
+        await flush_counts()
+
+
+@tasks.loop(seconds=COUNTER_FLUSH_INTERVAL)
+async def flush_counters():
+    """
+    Periodically writes buffered word counts to the database, and the word
+    history to its file. Errors are reported rather than raised, as an error
+    would stop the loop and no count would be written again.
+    """
+    try:
+        await flush_counts()
+    except Exception:
+        traceback.print_exc()
+
+    try:
+        await history.save()
+    except Exception:
+        traceback.print_exc()
+
+
+@tasks.loop(seconds=LOG_SYNC_INTERVAL)
+async def sync_increment_log():
+    """
+    Periodically writes logged word count increments to disk, so every
+    increment since the last sync shares a single fsync.
+    """
+    await increment_log.sync()
+
+
+async def flush_counts():
+    """
+    Writes buffered word counts to the database and tells the other worker
+    processes about them, so their leaderboards stay current. The users being
+    written are locked so their words can't change part way through.
+    """
+    async with user_locks.hold_all(counters.pending.keys()):
+        flushed = await counters.flush(database)
+
+    if flushed:
+        broadcast('counted', flushed)
+
+
+async def load_words():
+    """
+    Rebuilds the word index and leaderboards from every user in the database.
+    """
+    users = await database.to_dict()
+    word_index.build(users)
+    unindexed_users.clear()
+
+    guilds = {}
+    for key, words in users.items():
+        if not is_legacy_key(key):
+            guilds.setdefault(parse_user_key(key)[0], {})[key] = words
+
+    for guild_id in set(guild_states) | set(guilds):
+        guild_state(guild_id).leaderboard.build(guilds.get(guild_id, {}))
+
+    # Every user is now indexed
+    listed.set()
+    prefetched.set()
+
+
+def restore_counts():
+    """
+    Buffers the word count increments that were logged but not written to the
+    database before the bot last stopped. They are added to the leaderboards
+    as each user is indexed.
+    """
+    counters.replay()
+
+
+async def index_user(key):
+    """
+    Indexes a user from the database the first time they are needed. Until
+    the users have been listed it isn't known who needs indexing, so this
+    waits for the list first.
+    """
+    await listed.wait()
+
+    if key in unindexed_users:
+        await reload_user(key)
+        unindexed_users.discard(key)
+
+
+def record_phase(phase, start):
+    """
+    Reports how long a phase of starting up took.
+    """
+    seconds = time.perf_counter() - start
+    metrics.STARTUP_SECONDS.set(seconds, phase)
+    print('Startup: {0} took {1:.3f}s'.format(phase, seconds))
+
+
+async def timed(phase, awaitable):
+    """
+    Awaits a phase of starting up and reports how long it took.
+    """
+    start = time.perf_counter()
+    result = await awaitable
+    record_phase(phase, start)
+    return result
+
+
+async def list_users():
+    """
+    Lists the users in the database, retrying until it succeeds, as no
+    message can be counted until it is known who is tracked.
+    """
+    delay = 1
+
+    while True:
+        try:
+            return await database.users()
+        except Exception:
+            traceback.print_exc()
+            print('Unable to list users, retrying in {0}s.'.format(delay))
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, LIST_USERS_MAX_DELAY)
+
+
+async def load_file(phase, awaitable):
+    """
+    Awaits the loading of a file at startup, only reporting an error, as the
+    bot can run without any of them.
+    """
+    try:
+        await timed(phase, awaitable)
+    except Exception:
+        traceback.print_exc()
+
+
+async def start_up():
+    """
+    Gets the bot's data ready in the background while it connects to Discord.
+    Users are indexed when they are first needed once they have been listed,
+    and every user is then indexed, a few at a time, for the commands that
+    work across users. If starting up fails before the users are listed,
+    nothing could be counted, so the bot stops.
+    """
+    try:
+        start = time.perf_counter()
+        restore_counts()
+        record_phase('restore_counts', start)
+
+        users, *_ = await asyncio.gather(timed('list_users', list_users()),
+                                         load_file('error_messages', emg.load()),
+                                         load_file('history', history.load()),
+                                         load_file('checkpoints', checkpoints.load()))
+        unindexed_users.update(key for key in users if not is_legacy_key(key) and not word_index.tracks(key))
+        listed.set()
+
+        semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+        # A user who fails to index is indexed again when first needed
+        async def prefetch(key):
+            async with semaphore:
+                try:
+                    await index_user(key)
+                except Exception:
+                    traceback.print_exc()
+
+        await timed('prefetch', asyncio.gather(*[prefetch(key) for key in list(unindexed_users)]))
+    except Exception:
+        traceback.print_exc()
+
+        if not listed.is_set():
+            await client.close()
+    finally:
+        prefetched.set()
+
+
+async def reload_user(key):
+    """
+    Rebuilds a user's entries in the word index and leaderboard from the
+    database, after another worker process changed their words.
+    """
+    words = await database.words(key)
+    leaderboard = leaderboard_for(key)
+
+    word_index.remove_user(key)
+    leaderboard.remove_user(key)
+
+    for word, count in words.items():
+        word_index.add(key, word)
+
+        # Include counts that are still buffered
+        count = counters.count(key, word, count)
+
+        if count > 0:
+            leaderboard.increment(key, word, count)
+
+
+async def handle_shard_event(kind, *args):
+    """
+    Called when another worker process broadcasts a change.
+    """
+    if kind == 'enable':
+        guild_state(args[0]).enabled = args[1]
+    elif kind == 'reply_channel':
+        guild_state(args[0]).channel = await get_reply_channel(args[1])
+    elif kind == 'reload_user':
+        await reload_user(args[0])
+    elif kind == 'reload_all':
+        await load_words()
+    elif kind == 'counted':
+        for key, words in args[0].items():
+            for word, amount in words.items():
+                leaderboard_for(key).increment(key, word, amount)
 
 
 @client.event
@@ -441,24 +1318,86 @@ async def on_ready():
     global channel
     channel = client.get_channel(int(os.getenv('YEET_CHAT')))
 
+    member_index.build(client.get_all_members())
+
+    if not flush_counters.is_running():
+        flush_counters.start()
+        record_phase('ready', STARTED)
+
+    if not sync_increment_log.is_running():
+        sync_increment_log.start()
+
+    if not ingest.running():
+        ingest.start(prefetched)
+
     print('Bot running')
 
 
+@client.event
+async def on_member_join(member):
+    """
+    Called when a member joins a server.
+    """
+    member_index.add(member)
+
+
+@client.event
+async def on_member_remove(member):
+    """
+    Called when a member leaves a server.
+    """
+    member_index.remove(member)
+
+
+@client.event
+async def on_member_update(before, after):
+    """
+    Called when a member's profile in a server changes.
+    """
+    member_index.rename(before, after)
+
+
+@client.event
+async def on_user_update(before, after):
+    """
+    Called when a user changes their username or discriminator.
+    """
+    member_index.rename(before, after)
+
+
 @client.event
 async def on_message(ctx):
     """
     Called when there is a message is sent in discord
     """
-    global enable
-    
     # Stop the bot responding to itself
     if ctx.author == client.user:
         return
 
+    metrics.MESSAGES.inc()
+
     if ctx.content[0] == CMD_IDENTIFIER:
         await client.process_commands(ctx)
-    else:
-        await check_message(ctx)
+    elif ctx.guild is not None and is_tracked(user_key(ctx.guild.id, ctx.author.id)):
+        # Only messages from tracked users are queued to be checked
+        await ingest.put(ctx, [ctx.guild.id, ctx.author.id, ctx.id, ctx.content])
+
+
+@client.event
+async def on_raw_message_edit(payload):
+    """
+    Called when a message is edited, even if it isn't in the message cache.
+    """
+    if 'content' in payload.data:
+        await recount_message(payload.message_id, payload.data['content'])
+
+
+@client.event
+async def on_raw_message_delete(payload):
+    """
+    Called when a message is deleted, even if it isn't in the message cache.
+    """
+    await recount_message(payload.message_id, None)
 
 
 @client.event
@@ -480,7 +1419,45 @@ async def on_command_error(ctx, error):
 
 ### MAIN ###
 
-if not debug:
-    keep_running()
+def run_bot(link=None):
+    """
+    Runs the bot in this process. When it is one of several worker processes,
+    the link is used to share changes with the others.
+    """
+    global shard_link
+
+    shard_link = link
+
+    record_phase('import', STARTED)
+
+    # Health and metrics are served from the bot's own event loop, on a
+    # separate port for each worker
+    client.loop.run_until_complete(keep_running(client.is_ready, port + WORKER_ID))
+    client.loop.create_task(metrics.monitor_loop_lag())
+
+    if shard_link is not None:
+        client.loop.create_task(shard_link.listen(handle_shard_event))
+
+    # Connect straight away and load the data in the background
+    client.loop.create_task(start_up())
+    client.run(os.getenv('BOT_TOKEN'))
+
+
+def run_worker(worker, inbox, outbox):
+    """
+    Entry point of each worker process started by the shard hub.
+    """
+    run_bot(ShardLink(worker, inbox, outbox))
+
+
+if __name__ == '__main__':
+    if WORKERS > 1:
+        # Workers count into the same database, which needs increments that
+        # are atomic across processes
+        if STORE != 'sqlite':
+            raise SystemExit('Running more than one worker needs STORE=sqlite.')
+
+        ShardHub(WORKERS, SHARD_COUNT).run(run_worker)
+    else:
+        run_bot()
 
-client.run(os.getenv('BOT_TOKEN'))
\ No newline at end of file
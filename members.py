@@ -0,0 +1,115 @@
+def member_name(member):
+    """
+    Returns the name#discriminator username of a member.
+    """
+    return member.name + '#' + member.discriminator
+
+
+class MemberIndex:
+    """
+    Index of every member the bot can see, keyed by both username and ID.
+    Built once when the bot starts and kept current through member events,
+    so looking up a member never scans the member cache.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.names = {}
+        self.guilds = {}
+
+        # The last username of each member who left, so they can still be
+        # named after they are gone
+        self.former = {}
+
+
+    def build(self, members):
+        """
+        Rebuilds the index from the given members. Members who left are
+        still remembered.
+        """
+        self.former.update(self.ids)
+        self.ids = {}
+        self.names = {}
+        self.guilds = {}
+
+        for member in members:
+            self.add(member)
+
+
+    def add(self, member):
+        """
+        Adds a member to the index. A user in several servers is counted once
+        per server so they stay indexed until they have left all of them.
+        """
+        name = member_name(member)
+
+        self.ids[name] = member.id
+        self.names[member.id] = name
+        self.former.pop(name, None)
+        self.guilds[member.id] = self.guilds.get(member.id, 0) + 1
+
+
+    def remove(self, member):
+        """
+        Removes a member from the index once they are in no servers the bot
+        can see.
+        """
+        count = self.guilds.get(member.id, 0) - 1
+
+        if count > 0:
+            self.guilds[member.id] = count
+            return
+
+        self.guilds.pop(member.id, None)
+        name = self.names.pop(member.id, None)
+
+        if name is not None and self.ids.get(name) == member.id:
+            del self.ids[name]
+            self.former[name] = member.id
+
+
+    def rename(self, before, after):
+        """
+        Updates the index when a member's username or discriminator changes.
+        """
+        if before.id not in self.names:
+            return
+
+        old_name = self.names[before.id]
+        new_name = member_name(after)
+
+        if old_name == new_name:
+            return
+
+        if self.ids.get(old_name) == before.id:
+            del self.ids[old_name]
+
+        self.ids[new_name] = after.id
+        self.names[after.id] = new_name
+
+
+    def get_id(self, username):
+        """
+        Returns the ID of the member with the given username. If there is none,
+        return None.
+        """
+        return self.ids.get(username)
+
+
+    def get_former_id(self, username):
+        """
+        Returns the ID of the member who last had the given username before
+        leaving every server the bot can see. If there is none, return None.
+        """
+        return self.former.get(username)
+
+
+    def __contains__(self, username):
+        return username in self.ids
+
+
+    def get_name(self, id):
+        """
+        Returns the username of the member with the given ID, or None if they
+        are not in any server the bot can see.
+        """
+        return self.names.get(id)
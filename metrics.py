@@ -0,0 +1,192 @@
+import asyncio
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_labels(names, values):
+    """
+    Returns labels in Prometheus format, like {operation="words"}.
+    """
+    if not names:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, value) for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    """
+    A value that only goes up, like the number of messages processed.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+
+
+    def inc(self, amount=1, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name + format_labels(self.labels, labels), value
+
+
+class Gauge:
+    """
+    A value that goes up and down. If a function is given, it is called to
+    read the value whenever the metrics are collected.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, description, function=None, labels=()):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.labels = labels
+        self.values = {} if labels else {(): 0}
+
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, self.function()
+            return
+
+        for labels, value in self.values.items():
+            yield self.name + format_labels(self.labels, labels), value
+
+
+class Histogram:
+    """
+    Counts observations, like latencies, in cumulative buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+
+
+    def observe(self, value, *labels):
+        counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0))
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+
+        self.values[labels] = (counts, total + value)
+
+
+    def samples(self):
+        names = self.labels + ('le',)
+
+        for labels, (counts, total) in self.values.items():
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                yield self.name + '_bucket' + format_labels(names, labels + (bound,)), count
+            yield self.name + '_sum' + format_labels(self.labels, labels), total
+            yield self.name + '_count' + format_labels(self.labels, labels), counts[-1]
+
+
+MESSAGES = Counter('wordchecker_messages_total', 'Messages processed.')
+MATCHES = Counter('wordchecker_matches_total', 'Tracked words matched in messages.')
+CHECK_LATENCY = Histogram('wordchecker_check_message_seconds', 'Time taken to check a message for tracked words.')
+
+STORE_OPERATIONS = Counter('wordchecker_store_operations_total', 'Store operations.', ('kind', 'operation'))
+STORE_LATENCY = Histogram('wordchecker_store_operation_seconds', 'Time taken by store operations.', ('kind', 'operation'))
+
+REPLY_QUEUE_DEPTH = Gauge('wordchecker_reply_queue_depth', 'Replies waiting to be sent.')
+INGEST_QUEUE_DEPTH = Gauge('wordchecker_ingest_queue_depth', 'Messages waiting to be checked for tracked words.')
+INGEST_OVERFLOW = Counter('wordchecker_ingest_overflow_total', 'Messages that arrived while the ingest queue was full.', ('policy',))
+LOOP_LAG = Gauge('wordchecker_event_loop_lag_seconds', 'How late the event loop last woke up a sleeping task.')
+STARTUP_SECONDS = Gauge('wordchecker_startup_phase_seconds', 'Time taken by each phase of starting up.', labels=('phase',))
+
+REGISTRY = [
+    MESSAGES,
+    MATCHES,
+    CHECK_LATENCY,
+    STORE_OPERATIONS,
+    STORE_LATENCY,
+    REPLY_QUEUE_DEPTH,
+    INGEST_QUEUE_DEPTH,
+    INGEST_OVERFLOW,
+    LOOP_LAG,
+    STARTUP_SECONDS,
+]
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text format.
+    """
+    lines = []
+
+    for metric in REGISTRY:
+        lines.append('# HELP {0} {1}'.format(metric.name, metric.description))
+        lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+
+        for name, value in metric.samples():
+            lines.append('{0} {1}'.format(name, value))
+
+    return '\n'.join(lines) + '\n'
+
+
+async def monitor_loop_lag(interval=1.0):
+    """
+    Measures how much later than asked the event loop wakes up from a sleep.
+    A large lag means something is blocking the loop.
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.set(max(0.0, time.perf_counter() - start - interval))
+
+
+STORE_READS = {'users', 'has_user', 'words', 'to_dict', 'counts'}
+STORE_WRITES = {'add_user', 'remove_user', 'clear', 'add_word', 'remove_word', 'clear_words', 'increment', 'migrate'}
+
+
+class MeasuredStore:
+    """
+    Wraps a store and records the count and latency of every operation.
+    """
+    def __init__(self, store):
+        self.store = store
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self.store, name)
+
+        if name not in STORE_READS and name not in STORE_WRITES:
+            return attribute
+
+        kind = 'read' if name in STORE_READS else 'write'
+
+        # Streamed rows are consumed by the caller, so only count the call
+        if name == 'counts':
+            def stream(*args, **kwargs):
+                STORE_OPERATIONS.inc(1, kind, name)
+                return attribute(*args, **kwargs)
+
+            return stream
+
+        async def measure(*args, **kwargs):
+            start = time.perf_counter()
+
+            try:
+                return await attribute(*args, **kwargs)
+            finally:
+                STORE_OPERATIONS.inc(1, kind, name)
+                STORE_LATENCY.observe(time.perf_counter() - start, kind, name)
+
+        return measure
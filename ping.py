@@ -1,18 +1,40 @@
-from flask import Flask
-from threading import Thread
+from aiohttp import web
 
-app = Flask('')
+import metrics
 
 host = '0.0.0.0'
 port = 8080
 
-@app.route('/')
-def home():
-    return 'Discord Word Checker bot is running.'
 
-def run():
-    app.run(host=host, port=port)
+async def home(request):
+    return web.Response(text='Discord Word Checker bot is running.')
 
-def keep_running():
-    thread = Thread(target=run)
-    thread.start()
+
+async def prometheus(request):
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def keep_running(is_healthy, port=port):
+    """
+    Starts the web server on the bot's own event loop. It serves the keep-alive
+    page, a health check that fails until is_healthy() returns True, and the
+    bot's metrics for Prometheus.
+    """
+    async def health(request):
+        if not is_healthy():
+            return web.Response(text='starting', status=503)
+        return web.Response(text='ok')
+
+    app = web.Application()
+    app.add_routes([
+        web.get('/', home),
+        web.get('/health', health),
+        web.get('/metrics', prometheus),
+    ])
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    return runner
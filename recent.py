@@ -0,0 +1,90 @@
+from collections import Counter, OrderedDict
+
+
+class RecentMatches:
+    """
+    The tracked words matched in the most recent messages from tracked
+    users, so an edit or delete can be counted from the words that changed
+    without looking the message up again. Only the last max_size messages
+    are kept, and the least recently used is forgotten first.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.messages = OrderedDict()
+
+        # The messages kept for each user
+        self.users = {}
+
+
+    def remember(self, message_id, username, words, timestamp):
+        """
+        Keeps the user key, matched words and time of a message.
+        """
+        self.messages[message_id] = (username, Counter(words), timestamp)
+        self.messages.move_to_end(message_id)
+        self.users.setdefault(username, set()).add(message_id)
+
+        if len(self.messages) > self.max_size:
+            oldest, (username, _, _) = self.messages.popitem(last=False)
+            self.unindex(username, oldest)
+
+
+    def get(self, message_id):
+        """
+        Returns the (username, words, timestamp) of a message, or None if it
+        isn't kept.
+        """
+        entry = self.messages.get(message_id)
+
+        if entry is not None:
+            self.messages.move_to_end(message_id)
+        return entry
+
+
+    def forget(self, message_id):
+        """
+        Stops keeping a message and returns its (username, words, timestamp),
+        or None if it wasn't kept.
+        """
+        entry = self.messages.pop(message_id, None)
+
+        if entry is not None:
+            self.unindex(entry[0], message_id)
+        return entry
+
+
+    def forget_word(self, username, word=None):
+        """
+        Drops a word, or all of a user's words if no word is given, from the
+        user's kept messages, so editing or deleting a message from before
+        the word was removed never changes its count.
+        """
+        if word is None:
+            for message_id in self.users.pop(username, ()):
+                del self.messages[message_id]
+            return
+
+        for message_id in self.users.get(username, ()):
+            self.messages[message_id][1].pop(word, None)
+
+
+    def unindex(self, username, message_id):
+        message_ids = self.users.get(username)
+
+        if message_ids is not None:
+            message_ids.discard(message_id)
+
+            if not message_ids:
+                del self.users[username]
+
+
+    def __len__(self):
+        return len(self.messages)
+
+
+def diff(old, new):
+    """
+    Returns the change in count of each word from one multiset of words to
+    another, leaving out words whose count didn't change.
+    """
+    return {word: new[word] - old[word] for word in old.keys() | new.keys() if new[word] != old[word]}
@@ -0,0 +1,177 @@
+import asyncio
+
+import discord
+
+MESSAGE_LIMIT = 2000
+
+
+def split_message(message, limit=MESSAGE_LIMIT):
+    """
+    Splits a message into chunks no longer than Discord's message limit,
+    breaking between lines where possible.
+    """
+    chunks = []
+    current = ''
+
+    for line in message.split('\n'):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ''
+
+            chunks.append(line[:limit])
+            line = line[limit:]
+
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        elif current:
+            current += '\n' + line
+        else:
+            current = line
+
+    if current.strip():
+        chunks.append(current)
+
+    return chunks
+
+
+def merge_replies(replies):
+    """
+    Merges consecutive text replies into as few messages as possible. Embeds
+    and files are kept as their own messages, in order.
+    """
+    text = []
+
+    for reply in replies:
+        if isinstance(reply, str):
+            text.append(reply)
+            continue
+
+        if text:
+            for chunk in split_message('\n'.join(text)):
+                yield {'content': chunk}
+            text = []
+
+        yield reply
+
+    if text:
+        for chunk in split_message('\n'.join(text)):
+            yield {'content': chunk}
+
+
+class ReplyQueue:
+    """
+    Outbound queue of replies for each channel. Text replies sent to a channel
+    within a short window are merged into as few messages as possible, and
+    each channel sends one message at a time so a burst of replies doesn't
+    run into Discord's rate limits.
+    """
+    def __init__(self, window=0.5, retries=3):
+        self.window = window
+        self.retries = retries
+        self.pending = {}
+        self.tasks = {}
+
+
+    def send(self, destination, message):
+        """
+        Queues a message to be sent to a channel. Empty messages are skipped.
+        Returns right away without waiting for the message to be sent.
+        """
+        message = message.rstrip('\n')
+
+        if not message.strip():
+            return
+
+        self.enqueue(destination, message)
+
+
+    def send_embed(self, destination, embed):
+        """
+        Queues an embed to be sent to a channel as its own message.
+        """
+        self.enqueue(destination, {'embed': embed})
+
+
+    def send_file(self, destination, file, message=None):
+        """
+        Queues a file to be sent to a channel as its own message.
+        """
+        self.enqueue(destination, {'content': message, 'file': file})
+
+
+    def enqueue(self, destination, reply):
+        """
+        Adds a reply to a channel's queue and starts delivering the queue if it
+        isn't already.
+        """
+        self.pending.setdefault(destination, []).append(reply)
+
+        if destination not in self.tasks:
+            self.tasks[destination] = asyncio.ensure_future(self.deliver(destination))
+
+
+    def depth(self):
+        """
+        Returns the number of replies waiting to be sent.
+        """
+        return sum(len(messages) for messages in self.pending.values())
+
+
+    async def deliver(self, destination):
+        """
+        Waits for the merge window to pass, then sends everything queued for
+        a channel until nothing is left. A reply that can't be sent is
+        dropped, and the replies merged with it are put back to be sent
+        after a fresh window.
+        """
+        try:
+            await asyncio.sleep(self.window)
+
+            while self.pending.get(destination):
+                unsent = list(merge_replies(self.pending.pop(destination)))
+
+                while unsent:
+                    reply = unsent.pop(0)
+
+                    try:
+                        await self.post(destination, reply)
+                    except Exception as error:
+                        print('Unable to send reply: {0}'.format(error))
+
+                        # Put back in front of anything queued since
+                        self.pending[destination] = unsent + self.pending.get(destination, [])
+                        return
+        finally:
+            self.tasks.pop(destination, None)
+
+            if self.pending.get(destination):
+                self.tasks[destination] = asyncio.ensure_future(self.deliver(destination))
+
+
+    async def post(self, destination, reply):
+        """
+        Sends a single message. discord.py already waits out the rate limits it
+        is told about, so this only backs off for the Retry-After given when a
+        request is still rejected with a 429. Files are closed once sent, so
+        they are never retried.
+        """
+        for attempt in range(self.retries):
+            try:
+                await destination.send(**reply)
+                return
+            except discord.HTTPException as error:
+                if error.status != 429 or 'file' in reply or attempt == self.retries - 1:
+                    raise
+
+                retry_after = error.response.headers.get('Retry-After', 1)
+                await asyncio.sleep(float(retry_after))
+
+
+    async def flush(self):
+        """
+        Waits until every queued reply has been sent.
+        """
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks.values()), return_exceptions=True)
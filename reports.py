@@ -0,0 +1,106 @@
+import csv
+import io
+import tempfile
+
+import discord
+
+PAGE_LINES = 20
+PAGE_CHARS = 2048
+
+MAX_PAGES = 5
+
+
+async def iterate(items):
+    """
+    Yields the items of a regular iterable from an async generator, so lists
+    can be reported the same way as rows streamed from the store.
+    """
+    for item in items:
+        yield item
+
+
+async def paginate(rows, format_row, page_lines=PAGE_LINES, page_chars=PAGE_CHARS):
+    """
+    Groups rows into pages of at most page_lines rows, whose formatted lines
+    fit in page_chars characters.
+    """
+    page = []
+    size = 0
+
+    async for row in rows:
+        length = len(format_row(row)) + 1
+
+        if page and (len(page) >= page_lines or size + length > page_chars):
+            yield page
+            page = []
+            size = 0
+
+        page.append(row)
+        size += length
+
+    if page:
+        yield page
+
+
+def page_embed(title, page, format_row, number, total):
+    """
+    Returns an embed showing a single page of a report.
+    """
+    embed = discord.Embed(title=title, description='\n'.join(format_row(row) for row in page))
+    embed.set_footer(text='Page {0} of {1}'.format(number, total))
+
+    return embed
+
+
+async def write_csv(columns, pages, rest):
+    """
+    Writes a report to a temporary CSV file, starting with the pages already
+    read and then streaming the rest. Returns the file rewound to its start.
+    """
+    fp = tempfile.TemporaryFile()
+    text = io.TextIOWrapper(fp, encoding='utf-8', newline='')
+
+    writer = csv.writer(text)
+    writer.writerow(columns)
+
+    for page in pages:
+        writer.writerows(page)
+
+    async for page in rest:
+        writer.writerows(page)
+
+    text.flush()
+    text.detach()
+    fp.seek(0)
+
+    return fp
+
+
+async def send_report(replies, destination, title, columns, rows, format_row, filename, max_pages=MAX_PAGES):
+    """
+    Sends a report as a series of embeds, one per page. If the report runs
+    past max_pages, it is sent as an attached CSV file instead. At most
+    max_pages pages are held in memory, however many rows there are.
+    Returns False if there were no rows to report. Otherwise, return True.
+    """
+    pager = paginate(rows, format_row)
+    pages = []
+
+    async for page in pager:
+        pages.append(page)
+
+        if len(pages) > max_pages:
+            break
+
+    if not pages:
+        return False
+
+    if len(pages) > max_pages:
+        fp = await write_csv(columns, pages, pager)
+        replies.send_file(destination, discord.File(fp, filename=filename), title)
+        return True
+
+    for number, page in enumerate(pages, 1):
+        replies.send_embed(destination, page_embed(title, page, format_row, number, len(pages)))
+
+    return True
@@ -0,0 +1,97 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+
+
+def assign_shards(shard_count, workers):
+    """
+    Returns the list of shard IDs that each worker process connects with.
+    """
+    return [list(range(worker, shard_count, workers)) for worker in range(workers)]
+
+
+class ShardHub:
+    """
+    Runs the bot as several worker processes, each connected to Discord with
+    its own subset of shards, and relays events from each worker to all of
+    the others.
+    """
+    def __init__(self, workers, shard_count):
+        self.workers = workers
+        self.shard_count = shard_count
+        self.context = multiprocessing.get_context('spawn')
+
+
+    def run(self, target):
+        """
+        Starts a process per worker running target(worker, inbox, outbox) and
+        relays events between them until they have all stopped. Each worker
+        reads its shards from the SHARD_IDS and SHARD_COUNT environment
+        variables when it starts.
+        """
+        outbox = self.context.Queue()
+        inboxes = []
+        processes = []
+
+        for worker, shard_ids in enumerate(assign_shards(self.shard_count, self.workers)):
+            os.environ['WORKER_ID'] = str(worker)
+            os.environ['SHARD_COUNT'] = str(self.shard_count)
+            os.environ['SHARD_IDS'] = ','.join(str(shard_id) for shard_id in shard_ids)
+
+            inbox = self.context.Queue()
+            process = self.context.Process(target=target, args=(worker, inbox, outbox), name='worker-{0}'.format(worker))
+            process.start()
+
+            inboxes.append(inbox)
+            processes.append(process)
+
+        try:
+            while any(process.is_alive() for process in processes):
+                try:
+                    sender, kind, args = outbox.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+                for worker, inbox in enumerate(inboxes):
+                    if worker != sender:
+                        inbox.put((kind, args))
+        finally:
+            for process in processes:
+                process.join()
+
+
+class ShardLink:
+    """
+    A worker process's connection to the hub, used to tell the other workers
+    about changes and to hear about theirs.
+    """
+    def __init__(self, worker, inbox, outbox):
+        self.worker = worker
+        self.inbox = inbox
+        self.outbox = outbox
+
+
+    def broadcast(self, kind, *args):
+        """
+        Sends an event to every other worker.
+        """
+        self.outbox.put((self.worker, kind, args))
+
+
+    async def listen(self, handler):
+        """
+        Calls handler(kind, *args) for every event sent by other workers.
+        """
+        loop = asyncio.get_event_loop()
+
+        while True:
+            try:
+                kind, args = await loop.run_in_executor(None, self.inbox.get, True, 1)
+            except queue.Empty:
+                continue
+
+            try:
+                await handler(kind, *args)
+            except Exception as error:
+                print('Unable to handle {0} event: {1}'.format(kind, error))
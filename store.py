@@ -0,0 +1,593 @@
+import asyncio
+import sqlite3
+
+from abc import ABC, abstractmethod
+
+from concurrent.futures import ThreadPoolExecutor
+
+import replit
+
+
+class Store(ABC):
+    """
+    Interface for where tracked users, their words and the word counts are
+    kept. Every method is a coroutine so the event loop never blocks on I/O.
+    """
+    @abstractmethod
+    async def users(self, prefix=''):
+        """
+        Returns a list of all tracked users, or only those whose usernames
+        start with a prefix if one is given.
+        """
+
+
+    @abstractmethod
+    async def has_user(self, username):
+        """
+        Return True if the user is being tracked. Otherwise, return False.
+        """
+
+
+    @abstractmethod
+    async def add_user(self, username):
+        """
+        Starts tracking a user with no words.
+        """
+
+
+    @abstractmethod
+    async def remove_user(self, username):
+        """
+        Stops tracking a user and removes all of their words.
+        """
+
+
+    @abstractmethod
+    async def clear(self):
+        """
+        Removes all users and words.
+        """
+
+
+    @abstractmethod
+    async def words(self, username):
+        """
+        Returns a dictionary of a user's tracked words to their counts.
+        """
+
+
+    @abstractmethod
+    async def add_word(self, username, word):
+        """
+        Starts tracking a word for a user with a count of zero.
+        """
+
+
+    @abstractmethod
+    async def remove_word(self, username, word):
+        """
+        Stops tracking a word for a user.
+        """
+
+
+    @abstractmethod
+    async def clear_words(self, username):
+        """
+        Removes all of a user's words.
+        """
+
+
+    @abstractmethod
+    async def increment(self, deltas):
+        """
+        Adds a dictionary of users to words to amounts onto the stored counts.
+        Words that are no longer tracked are ignored.
+        """
+
+
+    @abstractmethod
+    async def to_dict(self):
+        """
+        Returns a dictionary of every user to their words and counts.
+        """
+
+
+    @abstractmethod
+    async def counts(self, username=None, prefix=''):
+        """
+        Yields a (username, word, count) row for every tracked word, without
+        loading them all into memory at once. Only one user's words are
+        yielded if a username is given, or only those of users whose
+        usernames start with a prefix if one is given.
+        """
+
+
+    async def migrate(self):
+        """
+        Moves data from an older layout of the store into the current one.
+        Returns the number of users migrated.
+        """
+        return 0
+
+
+    async def close(self):
+        """
+        Releases any connections held by the store.
+        """
+        pass
+
+
+class MemoryStore(Store):
+    """
+    Store that keeps everything in a dictionary. Nothing is persisted, which
+    makes it useful for testing and benchmarking.
+    """
+    def __init__(self, data=None):
+        self.data = data if data is not None else {}
+
+
+    async def users(self, prefix=''):
+        return [username for username in self.data.keys() if username.startswith(prefix)]
+
+
+    async def has_user(self, username):
+        return username in self.data
+
+
+    async def add_user(self, username):
+        self.data.setdefault(username, {})
+
+
+    async def remove_user(self, username):
+        self.data.pop(username, None)
+
+
+    async def clear(self):
+        self.data.clear()
+
+
+    async def words(self, username):
+        return dict(self.data.get(username, {}))
+
+
+    async def add_word(self, username, word):
+        self.data[username].setdefault(word, 0)
+
+
+    async def remove_word(self, username, word):
+        self.data.get(username, {}).pop(word, None)
+
+
+    async def clear_words(self, username):
+        if username in self.data:
+            self.data[username] = {}
+
+
+    async def increment(self, deltas):
+        for username, words in deltas.items():
+            counts = self.data.get(username)
+            if counts is None:
+                continue
+
+            for word, amount in words.items():
+                if word in counts:
+                    counts[word] += amount
+
+
+    async def to_dict(self):
+        return {username: dict(words) for username, words in self.data.items()}
+
+
+    async def counts(self, username=None, prefix=''):
+        usernames = [username] if username is not None else [name for name in self.data.keys() if name.startswith(prefix)]
+
+        for username in usernames:
+            for word, count in list(self.data.get(username, {}).items()):
+                yield username, word, count
+
+
+class ReplitStore(MemoryStore):
+    """
+    Store backed by the Replit database through its aiohttp client. Each user
+    is kept under their own key, so a change only writes that user's words
+    instead of every user's. Only the list of keys is fetched up front, and
+    each user is fetched the first time they are needed and then cached in
+    memory, so startup doesn't grow with the size of the database.
+    """
+    def __init__(self, db_url, key):
+        super().__init__()
+        self.db_url = db_url
+        self.key = key
+        self.prefix = key + '/'
+        self.db = None
+        self.known = set()
+        self.listing = None
+        self.fetching = {}
+
+
+    def shard(self, username):
+        """
+        Returns the database key that a user's words are kept under.
+        """
+        return self.prefix + username
+
+
+    async def wait(self, future):
+        """
+        Waits for a fetch shared by several calls. The fetch isn't cancelled
+        if one of the callers is.
+        """
+        await asyncio.shield(future)
+
+
+    async def list_users(self):
+        """
+        Lists the users in the Replit database if they haven't been already.
+        Calls made while the users are being listed wait for the same request.
+        """
+        if self.listing is None:
+            self.listing = asyncio.ensure_future(self.fetch_keys())
+
+        try:
+            await self.wait(self.listing)
+        except Exception:
+            self.listing = None
+            raise
+
+
+    async def fetch_keys(self):
+        if self.db is None:
+            self.db = replit.AsyncDatabase(self.db_url)
+
+        keys = await self.db.list(self.prefix)
+        self.known = {key[len(self.prefix):] for key in keys}
+
+
+    async def load_user(self, username):
+        """
+        Loads a user from the Replit database if they haven't been already.
+        """
+        await self.list_users()
+
+        if username in self.data or username not in self.known:
+            return
+
+        if username not in self.fetching:
+            self.fetching[username] = asyncio.ensure_future(self.fetch_user(username))
+
+        try:
+            await self.wait(self.fetching[username])
+        finally:
+            self.fetching.pop(username, None)
+
+
+    async def fetch_user(self, username):
+        try:
+            words = await self.db.get(self.shard(username))
+        except KeyError:
+            words = {}
+
+        self.data.setdefault(username, words)
+
+
+    async def load(self):
+        """
+        Loads every user from the Replit database that hasn't been already.
+        """
+        await self.list_users()
+        await asyncio.gather(*[self.load_user(username) for username in list(self.known)])
+
+
+    async def save(self, *usernames):
+        """
+        Writes the given users back to the Replit database in a single request.
+        """
+        values = {self.shard(username): self.data[username] for username in usernames if username in self.data}
+
+        if values:
+            await self.db.set_bulk(values)
+
+
+    async def delete(self, username):
+        """
+        Deletes a user's key from the Replit database.
+        """
+        try:
+            await self.db.delete(self.shard(username))
+        except KeyError:
+            pass
+
+
+    async def users(self, prefix=''):
+        # Until every key has been listed, only list the keys asked for
+        if prefix and (self.listing is None or not self.listing.done()):
+            if self.db is None:
+                self.db = replit.AsyncDatabase(self.db_url)
+
+            keys = await self.db.list(self.shard(prefix))
+            return [key[len(self.prefix):] for key in keys]
+
+        await self.list_users()
+        return [username for username in self.known if username.startswith(prefix)]
+
+
+    async def has_user(self, username):
+        await self.list_users()
+        return username in self.known
+
+
+    async def add_user(self, username):
+        await self.load_user(username)
+        await super().add_user(username)
+        self.known.add(username)
+        await self.save(username)
+
+
+    async def remove_user(self, username):
+        await self.list_users()
+        await super().remove_user(username)
+        self.known.discard(username)
+        await self.delete(username)
+
+
+    async def clear(self):
+        await self.list_users()
+        usernames = list(self.known)
+        await super().clear()
+        self.known.clear()
+        await asyncio.gather(*[self.delete(username) for username in usernames])
+
+
+    async def words(self, username):
+        await self.load_user(username)
+        return await super().words(username)
+
+
+    async def add_word(self, username, word):
+        await self.load_user(username)
+        await super().add_word(username, word)
+        await self.save(username)
+
+
+    async def remove_word(self, username, word):
+        await self.load_user(username)
+        await super().remove_word(username, word)
+        await self.save(username)
+
+
+    async def clear_words(self, username):
+        await self.load_user(username)
+        await super().clear_words(username)
+        await self.save(username)
+
+
+    async def increment(self, deltas):
+        await asyncio.gather(*[self.load_user(username) for username in deltas])
+        await super().increment(deltas)
+        await self.save(*deltas.keys())
+
+
+    async def to_dict(self):
+        await self.load()
+        return await super().to_dict()
+
+
+    async def counts(self, username=None, prefix=''):
+        if username is not None:
+            await self.load_user(username)
+        elif prefix:
+            await asyncio.gather(*[self.load_user(username) for username in await self.users(prefix)])
+        else:
+            await self.load()
+
+        async for row in super().counts(username, prefix):
+            yield row
+
+
+    async def migrate(self):
+        """
+        Splits the single blob of every user, from before users had their own
+        keys, into one key per user. Counts for users that already have a key
+        are merged by keeping the larger count of each word. The blob is only
+        deleted once every user has been written.
+        """
+        await self.load()
+
+        try:
+            legacy = await self.db.get(self.key)
+        except KeyError:
+            return 0
+
+        for username, words in legacy.items():
+            counts = self.data.setdefault(username, {})
+
+            for word, count in words.items():
+                counts[word] = max(counts.get(word, 0), count)
+
+        self.known.update(legacy.keys())
+
+        await self.save(*legacy.keys())
+        await self.db.delete(self.key)
+
+        return len(legacy)
+
+
+    async def close(self):
+        if self.db is not None:
+            await self.db.sess.close()
+
+
+def prefix_end(prefix):
+    """
+    Returns the first string after every string that starts with a prefix,
+    so a range query can find them through an index.
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SQLiteStore(Store):
+    """
+    Store backed by a local SQLite database. Queries run on a dedicated thread
+    so they never block the event loop.
+    """
+    def __init__(self, path, batch_size=500):
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+
+    def connect(self):
+        """
+        Opens the SQLite database and creates the tables if they don't exist.
+        Must be called from the store's thread.
+        """
+        if self.connection is not None:
+            return
+
+        # Several worker processes may share the database, so wait on each
+        # other's locks and let readers run alongside a writer
+        self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS words (
+                username TEXT NOT NULL,
+                word TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (username, word)
+            );
+        ''')
+
+
+    def execute(self, statements):
+        """
+        Runs a list of (sql, parameters) statements in a single transaction and
+        returns the rows of the last one. Must be called from the store's thread.
+        """
+        self.connect()
+
+        rows = []
+        with self.connection:
+            for sql, parameters in statements:
+                if isinstance(parameters, list):
+                    rows = self.connection.executemany(sql, parameters).fetchall()
+                else:
+                    rows = self.connection.execute(sql, parameters).fetchall()
+
+        return rows
+
+
+    async def run(self, *statements):
+        """
+        Runs statements on the store's thread without blocking the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self.execute, statements)
+
+
+    async def users(self, prefix=''):
+        if prefix:
+            rows = await self.run(('SELECT username FROM users WHERE username >= ? AND username < ?',
+                                   (prefix, prefix_end(prefix))))
+        else:
+            rows = await self.run(('SELECT username FROM users', ()))
+
+        return [username for (username,) in rows]
+
+
+    async def has_user(self, username):
+        rows = await self.run(('SELECT 1 FROM users WHERE username = ?', (username,)))
+        return len(rows) > 0
+
+
+    async def add_user(self, username):
+        await self.run(('INSERT OR IGNORE INTO users VALUES (?)', (username,)))
+
+
+    async def remove_user(self, username):
+        await self.run(
+            ('DELETE FROM words WHERE username = ?', (username,)),
+            ('DELETE FROM users WHERE username = ?', (username,))
+        )
+
+
+    async def clear(self):
+        await self.run(('DELETE FROM words', ()), ('DELETE FROM users', ()))
+
+
+    async def words(self, username):
+        rows = await self.run(('SELECT word, count FROM words WHERE username = ?', (username,)))
+        return dict(rows)
+
+
+    async def add_word(self, username, word):
+        await self.run(('INSERT OR IGNORE INTO words (username, word) VALUES (?, ?)', (username, word)))
+
+
+    async def remove_word(self, username, word):
+        await self.run(('DELETE FROM words WHERE username = ? AND word = ?', (username, word)))
+
+
+    async def clear_words(self, username):
+        await self.run(('DELETE FROM words WHERE username = ?', (username,)))
+
+
+    async def increment(self, deltas):
+        parameters = [
+            (amount, username, word)
+            for username, words in deltas.items()
+            for word, amount in words.items()
+        ]
+
+        await self.run(('UPDATE words SET count = count + ? WHERE username = ? AND word = ?', parameters))
+
+
+    async def to_dict(self):
+        users = {username: {} for username in await self.users()}
+        rows = await self.run(('SELECT username, word, count FROM words', ()))
+
+        for username, word, count in rows:
+            users.setdefault(username, {})[word] = count
+
+        return users
+
+
+    async def counts(self, username=None, prefix=''):
+        # Fetch in batches, continuing after the last row of the previous one
+        if username is not None:
+            sql = 'SELECT username, word, count FROM words WHERE username = ? AND word > ? ORDER BY word LIMIT ?'
+            end = ()
+        elif prefix:
+            sql = ('SELECT username, word, count FROM words WHERE (username, word) > (?, ?) AND username < ? '
+                   'ORDER BY username, word LIMIT ?')
+            end = (prefix_end(prefix),)
+        else:
+            sql = 'SELECT username, word, count FROM words WHERE (username, word) > (?, ?) ORDER BY username, word LIMIT ?'
+            end = ()
+
+        after = (username if username is not None else prefix, '')
+
+        while True:
+            rows = await self.run((sql, after + end + (self.batch_size,)))
+
+            for row in rows:
+                yield row
+
+            if len(rows) < self.batch_size:
+                return
+
+            after = (rows[-1][0], rows[-1][1])
+
+
+    async def close(self):
+        def close_connection():
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, close_connection)
+        self.executor.shutdown()
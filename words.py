@@ -0,0 +1,226 @@
+import string
+import unicodedata
+
+from automaton import Automaton
+
+FOLDING = ('lower', 'unicode')
+
+
+def collapse(word):
+    """
+    Returns the canonical form of a word. The word is lowercased, stripped of
+    spaces and surrounding punctuation, and every run of a repeated character
+    is collapsed into one, so 'HeeeLLLo!' becomes 'helo'.
+    """
+    return collapse_runs(word.lower().replace(' ', '').strip(string.punctuation))
+
+
+def collapse_runs(text):
+    """
+    Collapses every run of a repeated character in the text into one.
+    """
+    chars = []
+    for char in text:
+        if not chars or chars[-1] != char:
+            chars.append(char)
+
+    return ''.join(chars)
+
+
+def fold(text, folding):
+    """
+    Folds the case of text. With 'unicode' folding, compatibility characters
+    such as full width letters are normalized and the text is casefolded, so
+    'Ｂｒｕｈ' and 'BRUH' fold the same. With 'lower', it is only lowercased.
+    """
+    if folding == 'unicode':
+        return unicodedata.normalize('NFKC', text).casefold()
+    return text.lower()
+
+
+class WordIndex:
+    """
+    Index of the words tracked for each user, keyed by their canonical form.
+    Matching a message token is a single collapse and a dictionary lookup, no
+    matter how many words the user is being tracked for.
+    """
+    def __init__(self):
+        self.users = {}
+
+
+    def build(self, database):
+        """
+        Rebuilds the index from the given database of users to tracked words.
+        """
+        self.users = {}
+
+        for username in database.keys():
+            for word in database[username].keys():
+                self.add(username, word)
+
+
+    def add(self, username, word):
+        """
+        Starts indexing the given word for a user. Words made only of
+        punctuation have no canonical form and are never indexed.
+        """
+        canonical = collapse(word)
+
+        if canonical:
+            self.users.setdefault(username, {})[canonical] = word
+
+
+    def remove(self, username, word):
+        """
+        Stops indexing the given word for a user.
+        """
+        words = self.users.get(username)
+
+        if words is not None:
+            words.pop(collapse(word), None)
+
+
+    def remove_user(self, username):
+        """
+        Removes all indexed words for a user.
+        """
+        self.users.pop(username, None)
+
+
+    def clear(self):
+        """
+        Removes all indexed words for every user.
+        """
+        self.users = {}
+
+
+    def tracks(self, username):
+        """
+        Return True if any words are indexed for the user. Otherwise, return False.
+        """
+        return bool(self.users.get(username))
+
+
+    def lookup(self, username, token):
+        """
+        Returns the tracked word that the given token is a spelling of for
+        a user. If there is none, return None.
+        """
+        words = self.users.get(username)
+
+        canonical = collapse(token)
+
+        if not words or not canonical:
+            return None
+        return words.get(canonical)
+
+
+    def match(self, username, content):
+        """
+        Returns the tracked words of a user in a message, once for each time
+        they were said. Each whitespace separated token is looked up whole.
+        """
+        words = self.users.get(username)
+
+        if not words:
+            return []
+
+        matches = []
+
+        for token in content.split():
+            canonical = collapse(token)
+            if not canonical:
+                continue
+
+            word = words.get(canonical)
+            if word is not None:
+                matches.append(word)
+
+        return matches
+
+
+class SubstringIndex(WordIndex):
+    """
+    Word index that also finds tracked words inside tokens, like 'lmao' in
+    'lmaoooXD' or 'bruh' in '(bruh)'. The message is folded and has its runs
+    collapsed, then scanned once with an automaton over the user's words.
+
+    With boundary set, a word only matches where it isn't joined on to other
+    letters or digits. Each user's automaton is built the first time it is
+    needed after their words change.
+    """
+    def __init__(self, boundary=False, folding='lower'):
+        if folding not in FOLDING:
+            raise ValueError('Unknown folding {0}.'.format(folding))
+
+        super().__init__()
+        self.boundary = boundary
+        self.folding = folding
+        self.automata = {}
+
+
+    def build(self, database):
+        self.automata = {}
+        super().build(database)
+
+
+    def add(self, username, word):
+        super().add(username, word)
+        self.automata.pop(username, None)
+
+
+    def remove(self, username, word):
+        super().remove(username, word)
+        self.automata.pop(username, None)
+
+
+    def remove_user(self, username):
+        super().remove_user(username)
+        self.automata.pop(username, None)
+
+
+    def clear(self):
+        super().clear()
+        self.automata = {}
+
+
+    def automaton(self, username):
+        """
+        Returns a user's automaton and a dictionary of its patterns to the
+        tracked words they came from, building them if their words changed.
+        """
+        if username not in self.automata:
+            patterns = {}
+
+            for canonical, word in self.users[username].items():
+                patterns[collapse_runs(fold(canonical, self.folding))] = word
+
+            self.automata[username] = (Automaton(patterns), patterns)
+
+        return self.automata[username]
+
+
+    def match(self, username, content):
+        """
+        Returns the tracked words of a user found anywhere in a message, once
+        for each time they were said.
+        """
+        if not self.users.get(username):
+            return []
+
+        automaton, patterns = self.automaton(username)
+        text = collapse_runs(fold(content, self.folding))
+        matches = []
+
+        for end, pattern in automaton.scan(text):
+            if self.boundary:
+                start = end - len(pattern) + 1
+
+                if start > 0 and text[start - 1].isalnum():
+                    continue
+                if end + 1 < len(text) and text[end + 1].isalnum():
+                    continue
+
+            matches.append(patterns[pattern])
+
+        return matches